@@ -1,22 +1,95 @@
 import tkinter as tk
+import json
 import os
+import queue
+import threading
+import time
+import traceback
+from collections import deque, namedtuple
 import pygame.mixer
 
+from book import OpeningBook, build_book, format_move
+from engine import BLACK, MAX_PLY, ChessEngine
+from latency import LatencyHistogram
+from parallel import ParallelSearch
+from perft import format_fen
+from profiling import MoveProfiler
+from tablebase import Tablebases
+
+# How often the Tk loop looks for a finished AI search, in milliseconds
+AI_POLL_INTERVAL = 50
+# Pause before the AI replies so red's move is drawn first, in
+# milliseconds (none with a reply budget), and the AI's search time in
+# seconds
+AI_MOVE_DELAY = 500
+AI_MOVE_TIME = 5.0
+# The AI deepens until its time runs out or it is stopped; this only
+# keeps the search inside the engine's ply tables
+AI_MAX_DEPTH = MAX_PLY - 1
+# With a reply budget, the part of it kept back for handing the move
+# from the search thread to the Tk loop, in seconds
+REPLY_MARGIN = 0.15
+# Finished games kept in game_history
+MAX_SAVED_GAMES = 100
+
+# One move of a game: (row, col) positions, the piece moved and the
+# piece it captured (None if none).  Replay rebuilds every position by
+# playing the moves forward and taking them back.
+MoveRecord = namedtuple('MoveRecord', 'from_pos to_pos piece captured')
+
 class ChineseChess:
 
-    def __init__(self):
+    def __init__(self, ai_processes=1, stats_log=None, reply_budget=None,
+                 profile_mode=None, profile_dir='profiles'):
 
         # Add these new variables for replay functionality
         self.move_history = []  # List to store moves for current game
         self.replay_mode = False
         self.current_replay_index = 0
-        self.saved_board_states = []  # To store board states for replay
         self.game_over = False  # Add this line
 
-        pygame.mixer.init()
-
         # Get absolute path
         current_dir = os.path.dirname(os.path.abspath(__file__))
+
+        # Opening book, compiled from openings.txt whenever the text is
+        # newer than the compiled book
+        book_path = os.path.join(current_dir, "openings.bin")
+        openings_path = os.path.join(current_dir, "openings.txt")
+        self.book = None
+        try:
+            if os.path.exists(openings_path) and (
+                    not os.path.exists(book_path)
+                    or os.path.getmtime(book_path) < os.path.getmtime(openings_path)):
+                with open(openings_path, encoding='utf-8') as f:
+                    build_book(f, book_path)
+            if os.path.exists(book_path):
+                self.book = OpeningBook(book_path)
+                print(f"Opening book loaded from: {book_path}")
+        except Exception as e:
+            print(f"Error loading opening book: {str(e)}")
+
+        # Endgame tablebases made by tablebase.py, if any were generated
+        tablebase_dir = os.path.join(current_dir, "tablebases")
+        self.tablebases = None
+        try:
+            if os.path.isdir(tablebase_dir):
+                self.tablebases = Tablebases(tablebase_dir)
+                print(f"Tablebases loaded: {', '.join(sorted(self.tablebases.tables))}")
+        except Exception as e:
+            print(f"Error loading tablebases: {str(e)}")
+
+        # With more than one process the AI splits its root moves over a
+        # process pool; start it before the audio mixer and Tk so the
+        # workers don't inherit them
+        self.parallel_search = None
+        if ai_processes > 1:
+            self.parallel_search = ParallelSearch(
+                ai_processes,
+                tablebase_dir=tablebase_dir if self.tablebases is not None else None
+            )
+
+        pygame.mixer.init()
+
         sound_path = os.path.join(current_dir, "piece_sound5.wav")
 
         try:
@@ -35,7 +108,7 @@ class ChineseChess:
         self.window = tk.Tk()
         self.window.title("Chinese Chess 6.7.86(test again)")
         
-        self.game_history = []  # List to store all games
+        self.game_history = deque(maxlen=MAX_SAVED_GAMES)  # Recent finished games
         
         # Board dimensions and styling
         self.board_size = 9  # 9x10 board
@@ -120,11 +193,54 @@ class ChineseChess:
         self.selected_piece = None
         self.highlighted_positions = []
         self.current_player = 'red'  # Red moves first
-        self.initialize_board()
+        self.engine = ChessEngine()
         self.draw_board()
+
+        # The AI searches its own engine in a worker thread and posts
+        # (move, stats, error) to ai_results, which the Tk loop polls.  In parallel
+        # mode that engine reads the pool's shared transposition table.
+        if self.parallel_search is not None:
+            self.search_engine = ChessEngine(tt=self.parallel_search.tt)
+        else:
+            self.search_engine = ChessEngine()
+        self.search_engine.tablebases = self.tablebases
+        self.ai_results = queue.Queue()
+        self.ai_worker = None
+        self.ai_cancel = None
+        self.ai_after_id = None
+        self.ai_stop_id = None
+        self.ai_thinking = False
+
+        # While red thinks the worker searches the reply red is expected
+        # to play (ponder_move); ponder_result holds its answer and
+        # search stats if that search finishes before red moves
+        self.ponder_move = None
+        self.ponder_result = None
+        # File that gets one JSON line of search statistics per AI move
+        self.stats_log = stats_log
+        # With a reply budget the AI always answers within that many
+        # seconds of red's move, with the best move found by then.
+        # latencies keeps the recent reply times; F9 prints them.
+        self.reply_budget = reply_budget
+        self.reply_started = None
+        self.latencies = LatencyHistogram()
+        # With a profile mode ('cprofile' or 'sample') every search for
+        # an AI move is profiled into a file per move in profile_dir;
+        # ponder searches are not, as they run for as long as red thinks
+        self.profiler = MoveProfiler(profile_dir, profile_mode) if profile_mode else None
                     
         # Bind mouse event
         self.canvas.bind('<Button-1>', self.on_click)
+        self.window.bind('<F9>', lambda event: self.dump_latencies())
+        self.window.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    @property
+    def board(self):
+        """Snapshot of the engine's board as rows of piece strings"""
+        return self.engine.get_board()
+
+    def initialize_board(self):
+        self.engine.initialize_board()
 
     def show_centered_warning(self, title, message):
         """Shows a warning messagebox centered on the game board"""
@@ -182,65 +298,6 @@ class ChineseChess:
         warn_window.focus_set()
         warn_window.wait_window()        
 
-    def evaluate_checkmate_potential(self, color):
-        """Evaluate how close we are to achieving checkmate"""
-        opposing_color = 'red' if color == 'black' else 'black'
-        kings = self.find_kings()
-        opponent_king_pos = kings[0] if color == 'black' else kings[1]
-        score = 0
-        
-        if not opponent_king_pos:
-            return 0
-            
-        king_row, king_col = opponent_king_pos
-        
-        # Count attacking pieces near opponent's king
-        attackers = 0
-        attack_value = 0
-        for dr in range(-2, 3):
-            for dc in range(-2, 3):
-                r, c = king_row + dr, king_col + dc
-                if 0 <= r < 10 and 0 <= c < 9:
-                    piece = self.board[r][c]
-                    if piece and piece[0] == color[0].upper():
-                        attackers += 1
-                        # Higher value for powerful pieces near the king
-                        if piece[1] in ['車', '馬', '炮']:
-                            attack_value += 50
-                        else:
-                            attack_value += 20
-        
-        score += attackers * 30 + attack_value
-        
-        # Bonus if opponent's king has limited mobility
-        escape_moves = 0
-        for dr in [-1, 0, 1]:
-            for dc in [-1, 0, 1]:
-                r, c = king_row + dr, king_col + dc
-                if 0 <= r < 10 and 0 <= c < 9:
-                    if (r, c) != (king_row, king_col):
-                        if self.is_valid_move((king_row, king_col), (r, c)):
-                            # Try the move
-                            original_piece = self.board[r][c]
-                            self.board[r][c] = self.board[king_row][king_col]
-                            self.board[king_row][king_col] = None
-                            
-                            if not self.is_in_check(opposing_color):
-                                escape_moves += 1
-                                
-                            # Restore the position
-                            self.board[king_row][king_col] = self.board[r][c]
-                            self.board[r][c] = original_piece
-        
-        # Higher score when opponent has fewer escape moves
-        score += (9 - escape_moves) * 50
-        
-        # Extra bonus if opponent is in check
-        if self.is_in_check(opposing_color):
-            score += 200
-            
-        return score
-
     def handle_game_end(self):
         """Handle end of game tasks"""
         self.game_over = True
@@ -261,15 +318,9 @@ class ChineseChess:
         self.prev_move_button.config(state=tk.DISABLED)  # Disable previous move button
         self.next_move_button.config(state=tk.DISABLED)  # Disable next move button
 
-    def add_move_to_history(self, from_pos, to_pos, piece):
-        """Record a move and board state"""
-        move = {
-            'from_pos': from_pos,
-            'to_pos': to_pos,
-            'piece': piece,
-            'board_state': [row[:] for row in self.board]  # Deep copy of board
-        }
-        self.move_history.append(move)
+    def add_move_to_history(self, from_pos, to_pos, piece, captured):
+        """Record a move"""
+        self.move_history.append(MoveRecord(from_pos, to_pos, piece, captured))
 
     def start_replay(self):
 
@@ -299,12 +350,10 @@ class ChineseChess:
             return
             
         move = self.move_history[self.current_replay_index]
-        # Restore board state
-        for i in range(len(self.board)):
-            self.board[i] = move['board_state'][i][:]
+        self.engine.move_piece(move.from_pos, move.to_pos)
         
         # Highlight the move
-        self.highlighted_positions = [move['from_pos'], move['to_pos']]
+        self.highlighted_positions = [move.from_pos, move.to_pos]
         self.current_replay_index += 1
         
         # Enable previous button as we're not at the start
@@ -330,20 +379,13 @@ class ChineseChess:
         # Always enable next button when we go back
         self.next_move_button.config(state=tk.NORMAL)
         
-        # If there are moves to show, display the board state at that index
-        if self.current_replay_index > 0:
-            move = self.move_history[self.current_replay_index - 1]
-            # Restore board state
-            for i in range(len(self.board)):
-                self.board[i] = move['board_state'][i][:]
-        else:
-            # If we're at the beginning, show initial board
-            self.initialize_board()
+        # Take back the move that was shown last
+        self.engine.unmake_move()
         
         # Update highlights if not at the beginning
         if self.current_replay_index > 0:
             move = self.move_history[self.current_replay_index - 1]
-            self.highlighted_positions = [move['from_pos'], move['to_pos']]
+            self.highlighted_positions = [move.from_pos, move.to_pos]
         else:
             self.highlighted_positions = []
         
@@ -362,8 +404,8 @@ class ChineseChess:
             
     def on_click(self, event):
 
-        if self.replay_mode or self.game_over:  # Add game_over check
-            return  # Ignore clicks when game is over or in replay mode
+        if self.replay_mode or self.game_over or self.ai_thinking:
+            return  # Ignore clicks when game is over, in replay mode or while the AI moves
 
         # Convert click coordinates to board position (remove the center_offset from here)
         col = round((event.x - self.board_margin) / self.cell_size)
@@ -371,7 +413,7 @@ class ChineseChess:
         
         # Ensure click is within board bounds
         if 0 <= row < 10 and 0 <= col < 9:
-            clicked_piece = self.board[row][col]
+            clicked_piece = self.engine.piece_at(row, col)
             
             # If a piece is already selected
             if self.selected_piece:
@@ -384,19 +426,14 @@ class ChineseChess:
                     self.highlighted_positions = [(row, col)]  # Reset highlights for new selection
                     self.draw_board()
                 # If clicking on a valid move position
-                elif self.is_valid_move(self.selected_piece, (row, col)):
-                    # Store the current state to check for check
-                    original_piece = self.board[row][col]
-                    
+                elif self.engine.is_valid_move(self.selected_piece, (row, col)):
                     # Make the move temporarily
-                    self.board[row][col] = self.board[start_row][start_col]
-                    self.board[start_row][start_col] = None
+                    captured = self.engine.move_piece(self.selected_piece, (row, col))
                     
                     # Check if the move puts own king in check
-                    if self.is_in_check(self.current_player):
+                    if self.engine.is_in_check(self.current_player):
                         # Undo the move if it puts own king in check
-                        self.board[start_row][start_col] = self.board[row][col]
-                        self.board[row][col] = original_piece
+                        self.engine.unmake_move()
 
 
                         if self.current_player == 'red':
@@ -422,13 +459,22 @@ class ChineseChess:
                         self.add_move_to_history(
                             (start_row, start_col),
                             (row, col),
-                            self.board[row][col]
+                            self.engine.piece_at(row, col),
+                            captured
                         )
 
                         # Add this code:
                         if self.current_player == 'black':
-                            # Add a small delay before AI move
-                            self.window.after(500, self.make_ai_move)
+                            self.reply_started = time.time()
+                            if self.ponder_move == ((start_row, start_col), (row, col)):
+                                self.ponder_hit()
+                            else:
+                                # Drop the ponder search, its TT entries stay warm
+                                self.cancel_ai_move()
+                                # Add a small delay before AI move
+                                self.ai_thinking = True
+                                self.ai_after_id = self.window.after(self.ai_move_delay(),
+                                                                     self.make_ai_move)
 
 
                     # Reset selected piece
@@ -443,347 +489,168 @@ class ChineseChess:
                 self.highlighted_positions = [(row, col)]  # Initialize highlights with selected piece
                 self.draw_board()        
 
-    def evaluate_board(self):
-                
-        piece_values = {
-            '將': 0, '帥': 0,      # Kings - valued at 0 since they can't be captured
-            '車': 900,            # Chariot - most valuable piece
-            '馬': 400,            # Horse
-            '炮': 500,            # Cannon
-            '象': 200, '相': 200,  # Elephants
-            '士': 200, '仕': 200,  # Advisors
-            '卒': 100, '兵': 100   # Pawns - base value, will get bonus when advanced
-        }
-        
-        score = 0
-        for row in range(10):
-            for col in range(9):
-                piece = self.board[row][col]
-                if piece:
-                    value = piece_values[piece[1]]
-                    if piece[0] == 'B':  # Black pieces (AI)
-                        score += value
-                        # Bonus for advanced positions
-                        if piece[1] in ['卒', '炮']:
-                            score += (row * 10)  # Encourage forward movement
-                    else:  # Red pieces (Human)
-                        score -= value
-                        if piece[1] in ['兵', '炮']:
-                            score -= ((9 - row) * 10)
-        
-        return score
-
-    def get_all_valid_moves(self, color):
-        """Get all valid moves for a given color"""
-        moves = []
-        for from_row in range(10):
-            for from_col in range(9):
-                piece = self.board[from_row][from_col]
-                if piece and piece[0] == color[0].upper():
-                    for to_row in range(10):
-                        for to_col in range(9):
-                            if self.is_valid_move((from_row, from_col), (to_row, to_col)):
-                                moves.append(((from_row, from_col), (to_row, to_col)))
-        return moves
-
-    def _move_sorting_score(self, move):
-        from_pos, to_pos = move
-        from_piece = self.board[from_pos[0]][from_pos[1]]
-        to_piece = self.board[to_pos[0]][to_pos[1]]
-        
-        score = 0
-        piece_values = {
-            '將': 0, '帥': 0,
-            '車': 900,
-            '馬': 400,
-            '炮': 500,
-            '象': 200, '相': 200,
-            '士': 200, '仕': 200,
-            '卒': 100, '兵': 100
-        }
-        
-        # Try the move
-        original_piece = self.board[to_pos[0]][to_pos[1]]
-        self.board[to_pos[0]][to_pos[1]] = from_piece
-        self.board[from_pos[0]][from_pos[1]] = None
-        
-        # Highest priority for checkmate
-        if self.is_checkmate('red'):
-            score += 10000
-        # High priority for check
-        elif self.is_in_check('red'):
-            score += 1000
-            # Additional bonus if the opponent has limited escape moves
-            escape_moves = 0
-            kings = self.find_kings()
-            king_pos = kings[0]  # Red king
-            if king_pos:
-                king_row, king_col = king_pos
-                for dr in [-1, 0, 1]:
-                    for dc in [-1, 0, 1]:
-                        r, c = king_row + dr, king_col + dc
-                        if 0 <= r < 10 and 0 <= c < 9:
-                            if self.is_valid_move((king_row, king_col), (r, c)):
-                                escape_moves += 1
-            score += (9 - escape_moves) * 100
-        
-        # Evaluate material gain/loss
-        if to_piece:  # Capture move
-            score += piece_values[to_piece[1]] * 10
-        
-        # Position improvement
-        if from_piece[1] in ['車', '馬', '炮']:
-            if 2 <= to_pos[1] <= 6:  # Central files
-                score += 30
-            if from_piece[0] == 'B' and to_pos[0] > 4:  # Crossing river
-                score += 40
-        
-        # Restore position
-        self.board[from_pos[0]][from_pos[1]] = from_piece
-        self.board[to_pos[0]][to_pos[1]] = original_piece
-        
-        return score
-
-    def evaluate_king_safety(self, color):
-        """Evaluate king safety and surrounding protection"""
-        kings = self.find_kings()
-        king_pos = kings[1] if color == 'black' else kings[0]
-        if not king_pos:
-            return -9999
-        
-        king_row, king_col = king_pos
-        safety = 0
-        
-        # Check protecting pieces
-        for dr in [-1, 0, 1]:
-            for dc in [-1, 0, 1]:
-                r, c = king_row + dr, king_col + dc
-                if 0 <= r < 10 and 0 <= c < 9:
-                    piece = self.board[r][c]
-                    if piece and piece[0] == color[0].upper():
-                        safety += 30
-        
-        # Penalty for exposed king
-        if self.is_in_check(color):
-            safety -= 200
-        
-        return safety
-
-    def evaluate_position_simple(self):
-        piece_values = {
-            '將': 0, '帥': 0,
-            '車': 900,
-            '馬': 400,
-            '炮': 500,
-            '象': 200, '相': 200,
-            '士': 200, '仕': 200,
-            '卒': 100, '兵': 100
-        }
-        
-        score = 0
-        
-        # Material and position evaluation
-        for row in range(10):
-            for col in range(9):
-                piece = self.board[row][col]
-                if piece:
-                    value = piece_values[piece[1]]
-                    position_bonus = 0
-                    
-                    if piece[1] in ['車', '馬', '炮']:
-                        # Bonus for controlling center files
-                        if 2 <= col <= 6:
-                            position_bonus += 20
-                        # Bonus for penetration
-                        if piece[0] == 'B' and row > 4:
-                            position_bonus += 50
-                        elif piece[0] == 'R' and row < 5:
-                            position_bonus += 50
-                    
-                    # Calculate piece safety
-                    safety_score = self.evaluate_piece_safety(row, col, piece, 'black' if piece[0] == 'B' else 'red')
-                    
-                    if piece[0] == 'B':  # Black pieces (AI)
-                        score += value + position_bonus + safety_score
-                        if piece[1] == '卒':
-                            if row > 4:  # Crossed river
-                                score += 50 + (row - 4) * 20
-                            else:
-                                score += row * 10
-                    else:  # Red pieces (Human)
-                        score -= value + position_bonus + safety_score
-                        if piece[1] == '兵':
-                            if row < 5:
-                                score -= 50 + (4 - row) * 20
-                            else:
-                                score -= (9 - row) * 10
-        
-        # Add checkmate potential evaluation
-        checkmate_score = self.evaluate_checkmate_potential('black') - self.evaluate_checkmate_potential('red')
-        score += checkmate_score * 2  # Give high weight to checkmate potential
-        
-        # King safety evaluation
-        king_safety = self.evaluate_king_safety('black') - self.evaluate_king_safety('red')
-        score += king_safety
-        
-        return score
+    def make_ai_move(self):
+        """Play a book move, or search for black's reply in a worker thread"""
+        if self.book is not None:
+            book_move = self.book.choose_move(self.engine)
+            if book_move:
+                self.play_ai_move(book_move, source='book')
+                return
+
+        # In a tabled ending play the move that mates fastest
+        if self.tablebases is not None:
+            tablebase_move = self.tablebases.best_move(self.engine)
+            if tablebase_move:
+                self.play_ai_move(tablebase_move, source='tablebase')
+                return
+
+        self.search_engine.set_board(self.board)
+        self.start_search(max_time=self.search_time(), profile=True)
+
+    def ai_move_delay(self):
+        """Milliseconds to wait before the AI starts on its reply.
+
+        With a reply budget there is no wait: the search runs off the Tk
+        thread, so red's move is drawn while it runs, and the whole
+        budget less REPLY_MARGIN goes to the search.
+        """
+        if self.reply_budget is not None:
+            return 0
+        return AI_MOVE_DELAY
 
-    def minimax(self, depth, alpha, beta, maximizing_player):
-        """Minimax algorithm with alpha-beta pruning and simplified evaluation"""
-        if depth == 0:
-            return self.evaluate_position_simple()
-        
-        if maximizing_player:
-            max_eval = float('-inf')
-            moves = self.get_all_valid_moves('black')
-            
-            for from_pos, to_pos in moves:
-                # Store and make move
-                moving_piece = self.board[from_pos[0]][from_pos[1]]
-                captured_piece = self.board[to_pos[0]][to_pos[1]]
-                self.board[to_pos[0]][to_pos[1]] = moving_piece
-                self.board[from_pos[0]][from_pos[1]] = None
-                
-                if not self.is_in_check('black'):
-                    eval = self.minimax(depth - 1, alpha, beta, False)
-                    max_eval = max(max_eval, eval)
-                    alpha = max(alpha, eval)
-                
-                # Restore position
-                self.board[from_pos[0]][from_pos[1]] = moving_piece
-                self.board[to_pos[0]][to_pos[1]] = captured_piece
-                
-                if beta <= alpha:
-                    break
-            return max_eval if max_eval != float('-inf') else self.evaluate_position_simple()
-        else:
-            min_eval = float('inf')
-            moves = self.get_all_valid_moves('red')
-            
-            for from_pos, to_pos in moves:
-                moving_piece = self.board[from_pos[0]][from_pos[1]]
-                captured_piece = self.board[to_pos[0]][to_pos[1]]
-                self.board[to_pos[0]][to_pos[1]] = moving_piece
-                self.board[from_pos[0]][from_pos[1]] = None
-                
-                if not self.is_in_check('red'):
-                    eval = self.minimax(depth - 1, alpha, beta, True)
-                    min_eval = min(min_eval, eval)
-                    beta = min(beta, eval)
-                
-                # Restore position
-                self.board[from_pos[0]][from_pos[1]] = moving_piece
-                self.board[to_pos[0]][to_pos[1]] = captured_piece
-                
-                if beta <= alpha:
-                    break
-            return min_eval if min_eval != float('inf') else self.evaluate_position_simple()
-
-    def evaluate_piece_safety(self, row, col, piece, color):
-        """Evaluate how safe a piece is in its current position"""
-        safety_score = 0
-        piece_values = {
-            '將': 0, '帥': 0,
-            '車': 900,
-            '馬': 400,
-            '炮': 500,
-            '象': 200, '相': 200,
-            '士': 200, '仕': 200,
-            '卒': 100, '兵': 100
-        }
-        
-        # Check if the piece is under attack
-        is_attacked = False
-        defenders = 0
-        attackers = 0
-        
-        # Count attackers and defenders
-        for r in range(10):
-            for c in range(9):
-                checking_piece = self.board[r][c]
-                if checking_piece:
-                    if checking_piece[0] != color[0].upper():  # Enemy piece
-                        # If enemy can capture this piece
-                        if self.is_valid_move((r, c), (row, col)):
-                            attackers += 1
-                            is_attacked = True
-                            # Penalty based on value difference
-                            if piece_values[checking_piece[1]] < piece_values[piece[1]]:
-                                safety_score -= 50  # Extra penalty if threatened by lesser piece
-                    else:  # Friendly piece
-                        if self.is_valid_move((r, c), (row, col)):
-                            defenders += 1
-                            safety_score += 20  # Bonus for each defender
-        
-        # Heavy penalty if attacked and not defended
-        if is_attacked and defenders == 0:
-            safety_score -= 200
-        
-        # Bonus for defended pieces
-        if defenders > attackers:
-            safety_score += 100
-            
-        return safety_score
+    def search_time(self):
+        """Seconds the AI may still search for its reply"""
+        if self.reply_budget is None or self.reply_started is None:
+            return AI_MOVE_TIME
+        deadline = self.reply_started + self.reply_budget - REPLY_MARGIN
+        return max(0.0, deadline - time.time())
 
-    def make_ai_move(self):
-        import time
-        
-        start_time = time.time()
-        max_time = 5.0  # Reduced from 10.0 to make moves faster
-                
-        best_score = float('-inf')
+    def start_search(self, max_time, profile=False):
+        """Search the search engine's position in a worker thread.
+
+        With profile set the search runs under the profiler, if any.
+        """
+        self.ai_cancel = threading.Event()
+        self.ai_worker = threading.Thread(
+            target=self.search_worker,
+            args=(self.ai_cancel, max_time, profile),
+            daemon=True
+        )
+        self.ai_worker.start()
+        self.ai_after_id = self.window.after(AI_POLL_INTERVAL, self.poll_ai_move)
+
+    def search_worker(self, cancel, max_time, profile):
+        """Runs in the worker thread; must not touch any Tk widget.
+
+        Always posts a result, so the Tk loop never waits forever: if the
+        search fails the move is None and the error is passed along.
+        """
         best_move = None
-        best_moving_piece = None
-        
-        # Get all valid moves and sort them by preliminary evaluation
-        moves = self.get_all_valid_moves('black')
-        if not moves:
+        error = None
+        try:
+            if profile and self.profiler is not None:
+                fen = format_fen(self.search_engine.get_board(), BLACK)
+                best_move = self.profiler.run(fen, self.search, cancel, max_time)
+            else:
+                best_move = self.search(cancel, max_time)
+        except Exception as e:
+            traceback.print_exc()
+            error = e
+        finally:
+            self.ai_results.put((best_move, self.search_engine.stats, error))
+
+    def search(self, cancel, max_time):
+        if self.parallel_search is not None:
+            return self.parallel_search.find_best_move(
+                self.search_engine, max_time=max_time, max_depth=AI_MAX_DEPTH,
+                stop_event=cancel)
+        return self.search_engine.find_best_move(max_time=max_time, max_depth=AI_MAX_DEPTH,
+                                                 stop_event=cancel)
+
+    def poll_ai_move(self):
+        """Check from the Tk loop whether the AI search has finished"""
+        try:
+            best_move, stats, error = self.ai_results.get_nowait()
+        except queue.Empty:
+            self.ai_after_id = self.window.after(AI_POLL_INTERVAL, self.poll_ai_move)
             return
-        
-        # Sort moves by preliminary evaluation
-        moves.sort(key=self._move_sorting_score, reverse=True)
-        
-        # Check if opponent is in check
-        is_check = self.is_in_check('red')
-        max_depth = 6 if is_check else 4  # Search deeper when opponent is in check
-        
-        # Iterative deepening
-        for search_depth in range(2, max_depth + 1):
-            if time.time() - start_time > max_time:
-                break
-            
-            alpha = float('-inf')
-            beta = float('inf')
-            
-            for from_pos, to_pos in moves:
-                if time.time() - start_time > max_time:
-                    break
-                
-                moving_piece = self.board[from_pos[0]][from_pos[1]]
-                captured_piece = self.board[to_pos[0]][to_pos[1]]
-                
-                # Make temporary move
-                self.board[to_pos[0]][to_pos[1]] = moving_piece
-                self.board[from_pos[0]][from_pos[1]] = None
-                
-                if not self.is_in_check('black'):
-                    score = self.minimax(search_depth - 1, alpha, beta, False)
-                    
-                    if score > best_score:
-                        best_score = score
-                        best_move = (from_pos, to_pos)
-                        best_moving_piece = moving_piece
-                
-                # Restore position
-                self.board[from_pos[0]][from_pos[1]] = moving_piece
-                self.board[to_pos[0]][to_pos[1]] = captured_piece
-        
+
+        self.ai_after_id = None
+        self.ai_worker = None
+        if self.ai_stop_id is not None:
+            self.window.after_cancel(self.ai_stop_id)
+            self.ai_stop_id = None
+        if error is not None:
+            # Don't leave the board locked; the game can be restarted
+            self.ai_thinking = False
+            self.ponder_move = None
+            self.ponder_result = None
+            self.show_centered_warning("Error", f"电脑走棋出错: {str(error)}")
+        elif self.ai_thinking:
+            self.play_ai_move(best_move, stats)
+        else:
+            # Pondering finished before red moved
+            self.ponder_result = (best_move, stats)
+
+    def start_ponder(self):
+        """Search the expected red reply while the human thinks"""
+        self.search_engine.set_board(self.board)
+        reply = self.search_engine.expected_reply()
+        if reply is None:
+            return
+        self.search_engine.move_piece(*reply)
+        self.ponder_move = reply
+        self.ponder_result = None
+        self.start_search(max_time=float('inf'))
+
+    def ponder_hit(self):
+        """Red played the expected move: use the ponder search for it"""
+        self.ponder_move = None
+        self.ai_thinking = True
+        if self.ai_worker is None:
+            # Add a small delay before AI move
+            self.ai_after_id = self.window.after(self.ai_move_delay(),
+                                                 self.play_ai_move, *self.ponder_result)
+        else:
+            # Keep the search and its work so far, within the usual think time
+            self.ai_stop_id = self.window.after(int(self.search_time() * 1000),
+                                                self.ai_cancel.set)
+
+    def cancel_ai_move(self):
+        """Stop a pending, running or pondering AI search and drop its result"""
+        for after_id in (self.ai_after_id, self.ai_stop_id):
+            if after_id is not None:
+                self.window.after_cancel(after_id)
+        self.ai_after_id = None
+        self.ai_stop_id = None
+        if self.ai_worker is not None:
+            self.ai_cancel.set()
+            self.ai_worker.join()
+            self.ai_worker = None
+        while not self.ai_results.empty():
+            self.ai_results.get_nowait()
+        self.ai_thinking = False
+        self.ponder_move = None
+        self.ponder_result = None
+
+    def play_ai_move(self, best_move, stats=None, source='search'):
+        self.ai_after_id = None
+        self.ai_thinking = False
+
+        latency = None
+        if self.reply_started is not None:
+            latency = time.time() - self.reply_started
+            self.latencies.record(latency)
+            self.reply_started = None
+        if best_move and self.stats_log:
+            self.log_ai_move(best_move, stats, source, latency)
+
         # Make the best move found
         if best_move:
             from_pos, to_pos = best_move
+            best_moving_piece = self.engine.piece_at(*from_pos)
             # Make the actual move
-            self.board[to_pos[0]][to_pos[1]] = best_moving_piece
-            self.board[from_pos[0]][from_pos[1]] = None
+            captured = self.engine.move_piece(from_pos, to_pos)
             
             # Play sound if available
             if hasattr(self, 'move_sound') and self.move_sound:
@@ -794,54 +661,38 @@ class ChineseChess:
             self.current_player = 'red'
                         
             # Add this line to record the AI move
-            self.add_move_to_history(from_pos, to_pos, best_moving_piece)
+            self.add_move_to_history(from_pos, to_pos, best_moving_piece, captured)
 
             # Update display
             self.draw_board()
             
         # Check if the opponent is now in checkmate
-        if self.is_checkmate(self.current_player):
+        if self.engine.is_checkmate(self.current_player):
             self.handle_game_end()
+        elif best_move:
+            self.start_ponder()
+
+    def log_ai_move(self, best_move, stats, source, latency):
+        """Append the move and its search statistics to the stats log"""
+        (from_row, from_col), (to_row, to_col) = best_move
+        entry = {'move': format_move((from_row * 9 + from_col, to_row * 9 + to_col)),
+                 'source': source,
+                 'latency': round(latency, 4) if latency is not None else None}
+        if stats is not None:
+            entry.update(stats.as_dict())
+            entry['pv'] = [format_move(move) for move in stats.pv]
+            for iteration in entry['iterations']:
+                iteration['move'] = format_move(iteration['move'])
+        try:
+            with open(self.stats_log, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+        except OSError as e:
+            print(f"Error writing search stats: {str(e)}")
 
-    def is_checkmate(self, color):
-        """
-        Check if the given color is in checkmate.
-        Returns True if the player has no legal moves to escape check.
-        """
-        # If not in check, can't be checkmate
-        if not self.is_in_check(color):
-            return False
-            
-        # Try every possible move for every piece of the current player
-        for row in range(10):
-            for col in range(9):
-                piece = self.board[row][col]
-                if piece and piece[0] == color[0].upper():  # If it's current player's piece
-                    # Try all possible destinations
-                    for to_row in range(10):
-                        for to_col in range(9):
-                            if self.is_valid_move((row, col), (to_row, to_col)):
-                                # Try the move
-                                original_piece = self.board[to_row][to_col]
-                                self.board[to_row][to_col] = piece
-                                self.board[row][col] = None
-                                
-                                # Check if still in check
-                                still_in_check = self.is_in_check(color)
-                                
-                                # Undo the move
-                                self.board[row][col] = piece
-                                self.board[to_row][to_col] = original_piece
-                                
-                                # If any move gets out of check, not checkmate
-                                if not still_in_check:
-                                    return False
-        
-        # If no legal moves found, it's checkmate
-            
-        self.game_over = True  # Add this line
-
-        return True
+    def dump_latencies(self):
+        """Print the AI's recent reply times as a histogram"""
+        print("AI reply latency")
+        print(self.latencies.format())
 
     # YELLOW HIGHTLIGHT(2nd modification)
 
@@ -862,43 +713,6 @@ class ChineseChess:
             tags='highlight'
         )    
 
-    def initialize_board(self):
-        # Initialize empty board
-        self.board = [[None for _ in range(9)] for _ in range(10)]
-        
-        # Set up initial piece positions
-        self.setup_pieces()
-        
-    def setup_pieces(self):
-        # Red pieces (bottom)
-        red_pieces = {
-            (9, 0): 'R車', (9, 1): 'R馬', (9, 2): 'R相',
-            (9, 3): 'R仕', (9, 4): 'R帥', (9, 5): 'R仕',
-            (9, 6): 'R相', (9, 7): 'R馬', (9, 8): 'R車',
-            (7, 1): 'R炮', (7, 7): 'R炮',
-            (6, 0): 'R兵', (6, 2): 'R兵', (6, 4): 'R兵',
-            (6, 6): 'R兵', (6, 8): 'R兵'
-        }
-        
-        # Black pieces (top)
-        black_pieces = {
-            (0, 0): 'B車', (0, 1): 'B馬', (0, 2): 'B象',
-            (0, 3): 'B士', (0, 4): 'B將', (0, 5): 'B士',
-            (0, 6): 'B象', (0, 7): 'B馬', (0, 8): 'B車',
-            (2, 1): 'B炮', (2, 7): 'B炮',
-            (3, 0): 'B卒', (3, 2): 'B卒', (3, 4): 'B卒',
-            (3, 6): 'B卒', (3, 8): 'B卒'
-        }
-        
-        # Place pieces on board
-        for pos, piece in red_pieces.items():
-            row, col = pos
-            self.board[row][col] = piece
-            
-        for pos, piece in black_pieces.items():
-            row, col = pos
-            self.board[row][col] = piece
-
     def draw_board(self):
         # Clear canvas
         self.canvas.delete("all")
@@ -976,15 +790,16 @@ class ChineseChess:
         )
         
         # Draw pieces on intersections
+        board = self.board
         for row in range(10):
             for col in range(9):
-                if self.board[row][col]:
+                if board[row][col]:
                     # Calculate position on intersections
                     x = self.board_margin + col * self.cell_size
                     y = self.board_margin + row * self.cell_size
                     
                     # Draw piece circle
-                    color = 'red' if self.board[row][col][0] == 'R' else 'black'
+                    color = 'red' if board[row][col][0] == 'R' else 'black'
                     self.canvas.create_oval(
                         x - self.piece_radius, y - self.piece_radius,
                         x + self.piece_radius, y + self.piece_radius,
@@ -994,8 +809,8 @@ class ChineseChess:
                     )
                     
                     # Draw piece text
-                    piece_text = self.board[row][col][1]
-                    text_color = 'red' if self.board[row][col][0] == 'R' else 'black'
+                    piece_text = board[row][col][1]
+                    text_color = 'red' if board[row][col][0] == 'R' else 'black'
                     self.canvas.create_text(
                         x, y,
                         text=piece_text,
@@ -1090,6 +905,8 @@ class ChineseChess:
         victory_window.wait_window()
 
     def restart_game(self):
+        self.cancel_ai_move()
+
         # Store the current game's move history if it exists
         if self.move_history:
             self.game_history.append(self.move_history)
@@ -1110,281 +927,25 @@ class ChineseChess:
         self.initialize_board()
         self.draw_board()
 
-    # Add piece movement validation(8 functions)
-
-    def is_valid_move(self, from_pos, to_pos):
-        from_row, from_col = from_pos
-        to_row, to_col = to_pos
-        piece = self.board[from_row][from_col]
-        
-        # Basic validation
-        if not (0 <= to_row < 10 and 0 <= to_col < 9):
-            return False
-            
-        # Can't capture own pieces
-        if self.board[to_row][to_col] and self.board[to_row][to_col][0] == piece[0]:
-            return False
-        
-        # Get piece type (second character of the piece string)
-        piece_type = piece[1]
-        
-        # Check specific piece movement rules
-        if piece_type == '帥' or piece_type == '將':  # General/King
-            return self.is_valid_general_move(from_pos, to_pos)
-        elif piece_type == '仕' or piece_type == '士':  # Advisor
-            return self.is_valid_advisor_move(from_pos, to_pos)
-        elif piece_type == '相' or piece_type == '象':  # Elephant
-            return self.is_valid_elephant_move(from_pos, to_pos)
-        elif piece_type == '馬':  # Horse
-            return self.is_valid_horse_move(from_pos, to_pos)
-        elif piece_type == '車':  # Chariot
-            return self.is_valid_chariot_move(from_pos, to_pos)
-        elif piece_type == '炮':  # Cannon
-            return self.is_valid_cannon_move(from_pos, to_pos)
-        elif piece_type == '兵' or piece_type == '卒':  # Pawn
-            return self.is_valid_pawn_move(from_pos, to_pos)
-        
-        return False
-
-    def is_valid_general_move(self, from_pos, to_pos):
-        from_row, from_col = from_pos
-        to_row, to_col = to_pos
-        piece = self.board[from_row][from_col]
-        
-        # Check if move is within palace (3x3 grid)
-        if piece[0] == 'R':  # Red general
-            if not (7 <= to_row <= 9 and 3 <= to_col <= 5):
-                return False
-        else:  # Black general
-            if not (0 <= to_row <= 2 and 3 <= to_col <= 5):
-                return False
-        
-        # Can only move one step horizontally or vertically
-        if abs(to_row - from_row) + abs(to_col - from_col) != 1:
-            return False
-            
-        return True
-
-    def is_valid_advisor_move(self, from_pos, to_pos):
-        from_row, from_col = from_pos
-        to_row, to_col = to_pos
-        piece = self.board[from_row][from_col]
-        
-        # Check if move is within palace
-        if piece[0] == 'R':  # Red advisor
-            if not (7 <= to_row <= 9 and 3 <= to_col <= 5):
-                return False
-        else:  # Black advisor
-            if not (0 <= to_row <= 2 and 3 <= to_col <= 5):
-                return False
-        
-        # Must move exactly one step diagonally
-        if abs(to_row - from_row) != 1 or abs(to_col - from_col) != 1:
-            return False
-            
-        return True
-
-    def is_valid_elephant_move(self, from_pos, to_pos):
-        from_row, from_col = from_pos
-        to_row, to_col = to_pos
-        piece = self.board[from_row][from_col]
-        
-        # Cannot cross river
-        if piece[0] == 'R':  # Red elephant
-            if to_row < 5:  # Cannot cross river
-                return False
-        else:  # Black elephant
-            if to_row > 4:  # Cannot cross river
-                return False
-        
-        # Must move exactly two steps diagonally
-        if abs(to_row - from_row) != 2 or abs(to_col - from_col) != 2:
-            return False
-        
-        # Check if there's a piece blocking the elephant's path
-        blocking_row = (from_row + to_row) // 2
-        blocking_col = (from_col + to_col) // 2
-        if self.board[blocking_row][blocking_col]:
-            return False
-            
-        return True
-
-    def is_valid_horse_move(self, from_pos, to_pos):
-        from_row, from_col = from_pos
-        to_row, to_col = to_pos
-        
-        # Must move in an L-shape (2 steps in one direction, 1 step in perpendicular direction)
-        row_diff = abs(to_row - from_row)
-        col_diff = abs(to_col - from_col)
-        if not ((row_diff == 2 and col_diff == 1) or (row_diff == 1 and col_diff == 2)):
-            return False
-        
-        # Check for blocking piece
-        if row_diff == 2:
-            blocking_row = from_row + (1 if to_row > from_row else -1)
-            if self.board[blocking_row][from_col]:
-                return False
-        else:
-            blocking_col = from_col + (1 if to_col > from_col else -1)
-            if self.board[from_row][blocking_col]:
-                return False
-                
-        return True
-
-    def is_valid_chariot_move(self, from_pos, to_pos):
-        from_row, from_col = from_pos
-        to_row, to_col = to_pos
-        
-        # Must move horizontally or vertically
-        if from_row != to_row and from_col != to_col:
-            return False
-        
-        # Check if path is clear
-        if from_row == to_row:  # Horizontal move
-            start_col = min(from_col, to_col) + 1
-            end_col = max(from_col, to_col)
-            for col in range(start_col, end_col):
-                if self.board[from_row][col]:
-                    return False
-        else:  # Vertical move
-            start_row = min(from_row, to_row) + 1
-            end_row = max(from_row, to_row)
-            for row in range(start_row, end_row):
-                if self.board[row][from_col]:
-                    return False
-                    
-        return True
-
-    def is_valid_cannon_move(self, from_pos, to_pos):
-        from_row, from_col = from_pos
-        to_row, to_col = to_pos
-        
-        # Must move horizontally or vertically
-        if from_row != to_row and from_col != to_col:
-            return False
-        
-        # Count pieces between from and to positions
-        pieces_between = 0
-        if from_row == to_row:  # Horizontal move
-            start_col = min(from_col, to_col) + 1
-            end_col = max(from_col, to_col)
-            for col in range(start_col, end_col):
-                if self.board[from_row][col]:
-                    pieces_between += 1
-        else:  # Vertical move
-            start_row = min(from_row, to_row) + 1
-            end_row = max(from_row, to_row)
-            for row in range(start_row, end_row):
-                if self.board[row][from_col]:
-                    pieces_between += 1
-        
-        # If capturing, need exactly one piece between
-        if self.board[to_row][to_col]:
-            return pieces_between == 1
-        # If not capturing, path must be clear
-        return pieces_between == 0
-
-    def is_valid_pawn_move(self, from_pos, to_pos):
-        from_row, from_col = from_pos
-        to_row, to_col = to_pos
-        piece = self.board[from_row][from_col]
-        
-        if piece[0] == 'R':  # Red pawn
-            # Before crossing river
-            if from_row > 4:
-                # Can only move forward (up)
-                return to_col == from_col and to_row == from_row - 1
-            # After crossing river
-            else:
-                # Can move forward or sideways
-                return (to_col == from_col and to_row == from_row - 1) or \
-                       (to_row == from_row and abs(to_col - from_col) == 1)
-        else:  # Black pawn
-            # Before crossing river
-            if from_row < 5:
-                # Can only move forward (down)
-                return to_col == from_col and to_row == from_row + 1
-            # After crossing river
-            else:
-                # Can move forward or sideways
-                return (to_col == from_col and to_row == from_row + 1) or \
-                       (to_row == from_row and abs(to_col - from_col) == 1)
-
-    # the following 3 functions (conbined with on_click function) is to add the CHECK feature
-    def find_kings(self):
-        """Find positions of both kings/generals"""
-        red_king_pos = black_king_pos = None
-        for row in range(10):
-            for col in range(9):
-                piece = self.board[row][col]
-                if piece:
-                    if piece[1] == '帥':
-                        red_king_pos = (row, col)
-                    elif piece[1] == '將':
-                        black_king_pos = (row, col)
-        return red_king_pos, black_king_pos
-
-    def is_position_under_attack(self, pos, attacking_color):
-        """Check if a position is under attack by pieces of the given color"""
-        target_row, target_col = pos
-        
-        # Check from all positions on the board
-        for row in range(10):
-            for col in range(9):
-                piece = self.board[row][col]
-                if piece and piece[0] == attacking_color[0].upper():
-                    # Check if this piece can move to the target position
-                    if self.is_valid_move((row, col), pos):
-                        return True
-        return False  
-
-    def is_generals_facing(self):
-        """Check if the two generals are facing each other directly"""
-        red_king_pos, black_king_pos = self.find_kings()
-        
-        # If either king is missing, return False
-        if not red_king_pos or not black_king_pos:
-            return False
-            
-        red_row, red_col = red_king_pos
-        black_row, black_col = black_king_pos
-        
-        # Check if generals are in the same column
-        if red_col != black_col:
-            return False
-            
-        # Check if there are any pieces between the generals
-        start_row = min(red_row, black_row) + 1
-        end_row = max(red_row, black_row)
-        
-        for row in range(start_row, end_row):
-            if self.board[row][red_col]:  # If there's any piece between
-                return False
-                
-        # If we get here, the generals are facing each other
-        return True
-
-    def is_in_check(self, color):
-        """Check if the king of the given color is in check"""
-        red_king_pos, black_king_pos = self.find_kings()
-        
-        if not red_king_pos or not black_king_pos:
-            return False
-        
-        # First check the special case of facing generals
-        if self.is_generals_facing():
-            return True  # Both kings are in check in this case
-        
-        # Then check the normal cases of being under attack
-        if color == 'red':
-            return self.is_position_under_attack(red_king_pos, 'black')
-        else:
-            return self.is_position_under_attack(black_king_pos, 'red')
+    def on_close(self):
+        self.cancel_ai_move()
+        if self.parallel_search is not None:
+            self.parallel_search.close()
+        self.window.destroy()
 
     def run(self):
         self.window.mainloop()
 
 # Create and run the game
 if __name__ == "__main__":
-    game = ChineseChess()
+    # CHESS_AI_PROCESSES=4 lets the AI search on four cores,
+    # CHESS_STATS_LOG=search.jsonl logs the AI's search statistics and
+    # CHESS_REPLY_BUDGET=2 makes the AI always reply within 2 seconds
+    # and CHESS_PROFILE=cprofile or sample profiles every AI move's search
+    reply_budget = os.environ.get('CHESS_REPLY_BUDGET')
+    game = ChineseChess(ai_processes=int(os.environ.get('CHESS_AI_PROCESSES', '1')),
+                        stats_log=os.environ.get('CHESS_STATS_LOG'),
+                        reply_budget=float(reply_budget) if reply_budget else None,
+                        profile_mode=os.environ.get('CHESS_PROFILE'),
+                        profile_dir=os.environ.get('CHESS_PROFILE_DIR', 'profiles'))
     game.run()
\ No newline at end of file
@@ -0,0 +1,221 @@
+"""Search benchmark: fixed-depth searches over a set of positions.
+
+Every position is searched by ChessEngine.find_best_move to a fixed
+depth with no time limit, from a fresh engine so that the transposition
+table and move ordering start empty.  For each position the benchmark
+reports the nodes searched, nodes per second, the time at which each
+iteration of the iterative deepening finished (time to depth) and the
+move chosen.  With --repeat the fastest of several runs is kept.
+
+Results can be saved as a baseline JSON file and later runs compared
+against it.  A position is a regression, and makes the command exit
+with status 1, if it needs more nodes than in the baseline by more than
+the tolerance, or if its search got slower by more than the tolerance.
+Node counts don't depend on the machine.  Speeds do, so each search is
+preceded by a fixed calibration workload, perft over the perft suite,
+and a position's speed is compared as its nodes per second divided by
+the calibration's.  That ratio changes when the evaluation or move
+ordering gets slower but hardly between machines, and timing the two
+side by side keeps a machine that speeds up or slows down during the
+run from skewing it.  Positions searched in less than MIN_TIMED_SECONDS
+are too short to time and only have their nodes checked.  On a busy or
+shared machine, save and compare with --repeat 3 and, if need be, a
+larger --tolerance.  With --check-time the raw total time is compared
+as well, which only makes sense against a baseline saved on the same
+machine.
+
+    python bench.py                          # compare with bench_baseline.json
+    python bench.py --save                   # write a new baseline
+    python bench.py --check-time --repeat 3 --baseline local.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from book import format_move
+from engine import BLACK, ChessEngine
+from perft import PERFT_SUITE, parse_fen, perft
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'bench_baseline.json')
+
+# The calibration workload: the perft suite to this depth, timed this
+# many times before every search with the fastest kept
+CALIBRATION_DEPTH = 2
+CALIBRATION_ROUNDS = 5
+
+# Searches faster than this (in the baseline) are too noisy to compare speeds
+MIN_TIMED_SECONDS = 0.5
+
+# (name, FEN).  The search plays black, so black is to move in all of them.
+BENCH_POSITIONS = [
+    # Openings
+    ('central cannon', 'rnbakab1r/9/1c4nc1/p1p1p1p1p/9/9/P1P1P1P1P/1C2C1N2/9/RNBAKAB1R b'),
+    ('pawn opening', 'rnbakabnr/9/1c5c1/p1p1p3p/6p2/2P6/P3P1P1P/1C4NC1/9/RNBAKAB1R b'),
+    ('screen horses', 'r1bakab1r/9/1cn3nc1/p1p1p1p1p/9/2P6/P3P1P1P/1CN1C1N2/9/R1BAKAB1R b'),
+    # Middlegames
+    ('open files', '2bakab1r/9/r1n1c1n2/p1p1p3p/6p2/2P3P2/P3P3P/2N1C1N2/R8/2BAKAB1R b'),
+    ('cannon check', '2bakab2/9/2n1c1n2/p1p1C1p1p/9/2P6/P3P1P1P/4B1N2/4A4/2BAK4 b'),
+    # Endgames
+    ('rook endgame', '3k5/4a4/4b4/9/2n6/9/6R2/4B4/4A4/3AK4 b'),
+    ('pawn endgame', '4k4/9/3a5/4p4/9/2P6/9/4B4/9/3K5 b'),
+    ('horse endgame', '5k3/9/4b4/9/9/2N6/4n4/9/4P4/3K5 b'),
+]
+
+
+def calibrate(rounds=CALIBRATION_ROUNDS):
+    """Nodes per second of perft over the perft suite on this machine.
+
+    Perft only runs the move generator, so its speed follows the
+    machine and Python build but not the evaluation or move ordering.
+    """
+    engine = ChessEngine(tt_size=1)
+    positions = [parse_fen(fen) for _, fen, _ in PERFT_SUITE]
+    elapsed = float('inf')
+    for _ in range(rounds):
+        nodes = 0
+        start = time.perf_counter()
+        for board, side in positions:
+            engine.set_board(board)
+            nodes += perft(engine, CALIBRATION_DEPTH, side)
+        elapsed = min(elapsed, time.perf_counter() - start)
+    return round(nodes / max(elapsed, 1e-9))
+
+
+def bench_position(fen, depth, repeat=1):
+    """Search one position to depth; returns its results as a dict"""
+    board, side = parse_fen(fen)
+    if side != BLACK:
+        raise ValueError(f"the search plays black, but red is to move: {fen!r}")
+    elapsed = float('inf')
+    calibration = 0
+    for _ in range(repeat):
+        calibration = max(calibration, calibrate())
+        engine = ChessEngine()
+        engine.set_board(board)
+        start = time.perf_counter()
+        engine.find_best_move(max_time=float('inf'), max_depth=depth)
+        elapsed = min(elapsed, time.perf_counter() - start)
+
+    stats = engine.stats
+    _, score, move, _, _ = stats.iterations[-1]
+    return {
+        'nodes': stats.nodes,
+        'seconds': round(elapsed, 4),
+        'nodes_per_second': round(stats.nodes / max(elapsed, 1e-9)),
+        'calibration': calibration,
+        'time_to_depth': [round(seconds, 4) for _, _, _, _, seconds in stats.iterations],
+        'best_move': format_move(move),
+        'score': score,
+    }
+
+
+def run_bench(depth, repeat=1, out=sys.stdout):
+    """Search every benchmark position; returns {'depth', 'seconds', 'positions'}"""
+    results = {}
+    for name, fen in BENCH_POSITIONS:
+        result = bench_position(fen, depth, repeat)
+        results[name] = result
+        print(f"{name:16} {result['nodes']:8d} nodes  {result['seconds']:7.2f}s  "
+              f"{result['nodes_per_second']:7d} nodes/s "
+              f"({result['nodes_per_second'] / result['calibration']:.4f} of perft)  "
+              f"{result['best_move']} "
+              f"{result['score']:6}  time to depth "
+              + ' '.join(f"{seconds:.2f}" for seconds in result['time_to_depth']),
+              file=out)
+    total_nodes = sum(result['nodes'] for result in results.values())
+    total_time = sum(result['seconds'] for result in results.values())
+    print(f"total {total_nodes} nodes in {total_time:.2f}s, "
+          f"{total_nodes / max(total_time, 1e-9):.0f} nodes/s", file=out)
+    return {'depth': depth, 'seconds': round(total_time, 4), 'positions': results}
+
+
+def compare(results, baseline, tolerance, check_time=False):
+    """Compare a run with a baseline at the same depth.
+
+    Returns (regressions, notes) as lists of text lines; a changed best
+    move is only a note, since a better search may well change it.
+    Speeds are compared relative to each search's calibration; the total
+    time is only compared if check_time is set.
+    """
+    regressions = []
+    notes = []
+    if check_time and results['seconds'] > baseline['seconds'] * (1 + tolerance):
+        regressions.append(f"total {results['seconds']:.2f}s, "
+                           f"baseline {baseline['seconds']:.2f}s")
+    for name, result in results['positions'].items():
+        reference = baseline['positions'].get(name)
+        if reference is None:
+            notes.append(f"{name}: not in the baseline")
+            continue
+        if result['nodes'] > reference['nodes'] * (1 + tolerance):
+            regressions.append(f"{name}: {result['nodes']} nodes, "
+                               f"baseline {reference['nodes']}")
+        if 'calibration' not in reference:
+            notes.append(f"{name}: no calibration in the baseline; speed not compared")
+        elif reference['seconds'] >= MIN_TIMED_SECONDS:
+            speed = result['nodes_per_second'] / result['calibration']
+            reference_speed = reference['nodes_per_second'] / reference['calibration']
+            if speed * (1 + tolerance) < reference_speed:
+                regressions.append(f"{name}: {result['nodes_per_second']} nodes/s, "
+                                   f"{speed:.4f} of perft, baseline {reference_speed:.4f}")
+        if result['best_move'] != reference['best_move']:
+            notes.append(f"{name}: plays {result['best_move']} ({result['score']}), "
+                         f"baseline {reference['best_move']} ({reference['score']})")
+    for name in baseline['positions']:
+        if name not in results['positions']:
+            notes.append(f"{name}: in the baseline but not benchmarked")
+    return regressions, notes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depth', type=int, default=None,
+                        help="search depth (default: the baseline's, or 4)")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help='write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed increase in nodes or time as a fraction (default 0.25)')
+    parser.add_argument('--check-time', action='store_true',
+                        help="also fail if the raw total time regresses; only meaningful "
+                             "against a baseline from this machine")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='search each position this many times and keep the fastest')
+    args = parser.parse_args()
+
+    baseline = None
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    depth = args.depth or (baseline['depth'] if baseline else 4)
+    if baseline is not None and baseline['depth'] != depth:
+        sys.exit(f"{args.baseline} was searched to depth {baseline['depth']}, not {depth}")
+
+    results = run_bench(depth, args.repeat)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+        print(f"baseline written to {args.baseline}")
+        return
+    if baseline is None:
+        print(f"no baseline at {args.baseline}; run with --save to write one")
+        return
+
+    regressions, notes = compare(results, baseline, args.tolerance, args.check_time)
+    for note in notes:
+        print(f"note: {note}")
+    if regressions:
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        sys.exit(1)
+    print(f"no regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Opening book: a sorted binary file of (position key, move, weight).
+
+Each record is 12 bytes, little endian: the 64-bit Zobrist key of the
+position with the side to move folded in, the move as from_sq << 8 |
+to_sq, and a 16-bit weight.  Records are sorted by key, so OpeningBook
+memory-maps the file and finds a position's moves by binary search.
+
+The book is compiled from a text file with one opening line per row,
+written as moves in ICCS coordinates (files a-i from red's left, ranks
+0-9 from red's side, e.g. ``h2e2`` for the central cannon), red first.
+A move's weight is the number of lines that play it in that position.
+Text after ``#`` is a comment.
+
+    python book.py openings.txt openings.bin
+"""
+
+import mmap
+import os
+import random
+import struct
+import sys
+from collections import defaultdict
+
+from engine import BLACK, POS_OF, RED, ZOBRIST_BLACK_TO_MOVE, ChessEngine
+
+RECORD = struct.Struct('<QHH')
+KEY = struct.Struct('<Q')
+MAX_WEIGHT = 0xFFFF
+
+
+def book_key(engine, side):
+    """Key of the engine's position with side to move"""
+    return engine.zobrist_key ^ ZOBRIST_BLACK_TO_MOVE if side == BLACK else engine.zobrist_key
+
+
+def parse_move(text):
+    """Turn an ICCS move such as 'h2e2' into (from_sq, to_sq)"""
+    if (len(text) != 4 or text[0] not in 'abcdefghi' or text[2] not in 'abcdefghi'
+            or not text[1].isdigit() or not text[3].isdigit()):
+        raise ValueError(f"not an ICCS move: {text!r}")
+    from_sq = (9 - int(text[1])) * 9 + 'abcdefghi'.index(text[0])
+    to_sq = (9 - int(text[3])) * 9 + 'abcdefghi'.index(text[2])
+    return from_sq, to_sq
+
+
+def format_move(move):
+    """Turn (from_sq, to_sq) into ICCS notation"""
+    (from_row, from_col), (to_row, to_col) = POS_OF[move[0]], POS_OF[move[1]]
+    return f"{'abcdefghi'[from_col]}{9 - from_row}{'abcdefghi'[to_col]}{9 - to_row}"
+
+
+def build_book(lines, path):
+    """Compile opening lines into a book file; returns the record count.
+
+    Raises ValueError naming the line if a move is illegal.
+    """
+    weights = defaultdict(int)
+    engine = ChessEngine(tt_size=1)
+    for line_number, line in enumerate(lines, 1):
+        tokens = line.split('#', 1)[0].split()
+        if not tokens:
+            continue
+        engine.initialize_board()
+        side = RED
+        for token in tokens:
+            move = parse_move(token)
+            if move not in engine.generate_legal_moves(side):
+                raise ValueError(f"line {line_number}: illegal move {token}")
+            weights[book_key(engine, side), move] += 1
+            engine.make_move(move)
+            side = BLACK if side == RED else RED
+
+    # Written beside the book and renamed, so an interrupted build never
+    # leaves a truncated book newer than its source
+    with open(path + '.tmp', 'wb') as f:
+        for (key, move), weight in sorted(weights.items()):
+            f.write(RECORD.pack(key, move[0] << 8 | move[1], min(weight, MAX_WEIGHT)))
+    os.replace(path + '.tmp', path)
+    return len(weights)
+
+
+class OpeningBook:
+    """Read-only view of a book file, memory-mapped"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            size = f.seek(0, 2)
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.count = size // RECORD.size
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __len__(self):
+        return self.count
+
+    def moves(self, key):
+        """Book moves for a position key as [((from_sq, to_sq), weight)]"""
+        data = self.data
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if KEY.unpack_from(data, middle * RECORD.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        moves = []
+        for index in range(low, self.count):
+            record_key, move, weight = RECORD.unpack_from(data, index * RECORD.size)
+            if record_key != key:
+                break
+            moves.append(((move >> 8, move & 0xFF), weight))
+        return moves
+
+    def choose_move(self, engine, side=BLACK, rng=random):
+        """Pick a book move for side by weight, or None when out of book.
+
+        The move is returned as a pair of (row, col) positions.
+        """
+        moves = [(move, weight) for move, weight in self.moves(book_key(engine, side))
+                 if engine.is_valid_move(POS_OF[move[0]], POS_OF[move[1]])]
+        if not moves:
+            return None
+        move = rng.choices([move for move, _ in moves],
+                           weights=[weight for _, weight in moves])[0]
+        return POS_OF[move[0]], POS_OF[move[1]]
+
+
+def main():
+    if len(sys.argv) != 3:
+        sys.exit("usage: python book.py OPENINGS.txt BOOK.bin")
+    with open(sys.argv[1], encoding='utf-8') as f:
+        count = build_book(f, sys.argv[2])
+    print(f"{count} positions and moves written to {sys.argv[2]}")
+
+
+if __name__ == "__main__":
+    main()
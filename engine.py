@@ -0,0 +1,1653 @@
+"""Chinese chess engine: board, rules, search and evaluation.
+
+This module has no GUI or audio dependencies so it can be used from
+scripts, servers and worker processes.  ``ChineseChess`` in the game
+script is a Tk front end over ``ChessEngine``.
+
+The board is a flat list of 90 small integers, indexed by
+``row * 9 + col``.  A piece code is a colour bit (RED or BLACK) or'ed
+with a piece type; 0 is an empty square.  The two-character strings
+used by the GUI and the move history (``'R車'``, ``'B將'``, ...) are
+only produced at the edges by get_board/piece_at and read back by
+set_board.
+"""
+
+import random
+import time
+
+# Piece types
+KING = 1
+ADVISOR = 2
+ELEPHANT = 3
+HORSE = 4
+CHARIOT = 5
+CANNON = 6
+PAWN = 7
+TYPE_MASK = 7
+
+# Colours
+RED = 8
+BLACK = 16
+COLOR_MASK = RED | BLACK
+
+EMPTY = 0
+
+SIDES = {'red': RED, 'black': BLACK}
+
+# Conversion between piece codes and the strings used by the GUI
+PIECE_STRINGS = [None] * 24
+for _code, _name in (
+        (RED | KING, 'R帥'), (RED | ADVISOR, 'R仕'), (RED | ELEPHANT, 'R相'),
+        (RED | HORSE, 'R馬'), (RED | CHARIOT, 'R車'), (RED | CANNON, 'R炮'),
+        (RED | PAWN, 'R兵'),
+        (BLACK | KING, 'B將'), (BLACK | ADVISOR, 'B士'), (BLACK | ELEPHANT, 'B象'),
+        (BLACK | HORSE, 'B馬'), (BLACK | CHARIOT, 'B車'), (BLACK | CANNON, 'B炮'),
+        (BLACK | PAWN, 'B卒')):
+    PIECE_STRINGS[_code] = _name
+PIECE_CODES = {name: code for code, name in enumerate(PIECE_STRINGS) if name}
+
+# Material values indexed by piece type
+PIECE_VALUES = [0, 0, 200, 200, 400, 900, 500, 100]
+
+# Values used when resolving exchanges: the general is worth more than
+# anything it could win, so it only ever recaptures last
+EXCHANGE_VALUES = [0, 10000, 200, 200, 400, 900, 500, 100]
+
+ROW_OF = [sq // 9 for sq in range(90)]
+COL_OF = [sq % 9 for sq in range(90)]
+POS_OF = [(sq // 9, sq % 9) for sq in range(90)]
+
+
+def _on_board(row, col):
+    return 0 <= row < 10 and 0 <= col < 9
+
+
+def _in_palace(row, col, side):
+    if side == RED:
+        return 7 <= row <= 9 and 3 <= col <= 5
+    return 0 <= row <= 2 and 3 <= col <= 5
+
+
+def _build_move_tables():
+    """Precompute per-square targets for every piece type.
+
+    Leaper tables hold destination squares in ascending order (and the
+    blocking square where one exists), so the generator yields moves in
+    the same order as a full 90x90 scan.  Ray tables hold the squares
+    walked outward from a square in each of the four directions.
+    """
+    king, advisor, elephant, pawn = {}, {}, {}, {}
+    horse = [None] * 90
+    rays = [None] * 90
+    for side in (RED, BLACK):
+        king[side] = [None] * 90
+        advisor[side] = [None] * 90
+        elephant[side] = [None] * 90
+        pawn[side] = [None] * 90
+
+    for row in range(10):
+        for col in range(9):
+            sq = row * 9 + col
+
+            # Horse: L-shaped jump, blocked by the piece on its leg
+            targets = []
+            for dr, dc in ((-2, -1), (-2, 1), (-1, -2), (-1, 2),
+                           (1, -2), (1, 2), (2, -1), (2, 1)):
+                to_row, to_col = row + dr, col + dc
+                if _on_board(to_row, to_col):
+                    if abs(dr) == 2:
+                        leg = (row + dr // 2) * 9 + col
+                    else:
+                        leg = row * 9 + col + dc // 2
+                    targets.append((to_row * 9 + to_col, leg))
+            horse[sq] = targets
+
+            # Chariot and cannon: up, left, right, down
+            rays[sq] = [
+                [r * 9 + col for r in range(row - 1, -1, -1)],
+                [row * 9 + c for c in range(col - 1, -1, -1)],
+                [row * 9 + c for c in range(col + 1, 9)],
+                [r * 9 + col for r in range(row + 1, 10)],
+            ]
+
+            for side in (RED, BLACK):
+                king[side][sq] = [
+                    (row + dr) * 9 + col + dc
+                    for dr, dc in ((-1, 0), (0, -1), (0, 1), (1, 0))
+                    if _in_palace(row + dr, col + dc, side)
+                ]
+                advisor[side][sq] = [
+                    (row + dr) * 9 + col + dc
+                    for dr, dc in ((-1, -1), (-1, 1), (1, -1), (1, 1))
+                    if _in_palace(row + dr, col + dc, side)
+                ]
+
+                # Elephant: two diagonal steps on its own side of the river
+                targets = []
+                for dr, dc in ((-2, -2), (-2, 2), (2, -2), (2, 2)):
+                    to_row, to_col = row + dr, col + dc
+                    if not _on_board(to_row, to_col):
+                        continue
+                    if (side == RED and to_row < 5) or (side == BLACK and to_row > 4):
+                        continue
+                    targets.append((to_row * 9 + to_col,
+                                    (row + dr // 2) * 9 + col + dc // 2))
+                elephant[side][sq] = targets
+
+                # Pawn: forward only, plus sideways once across the river
+                forward = -1 if side == RED else 1
+                crossed = row <= 4 if side == RED else row >= 5
+                steps = [(forward, 0)]
+                if crossed:
+                    steps += [(0, -1), (0, 1)]
+                pawn[side][sq] = sorted(
+                    (row + dr) * 9 + col + dc for dr, dc in steps
+                    if _on_board(row + dr, col + dc)
+                )
+
+    return king, advisor, elephant, horse, rays, pawn
+
+
+(KING_MOVES, ADVISOR_MOVES, ELEPHANT_MOVES,
+ HORSE_MOVES, RAYS, PAWN_MOVES) = _build_move_tables()
+
+
+def _reverse_table(table, blocked=False):
+    """Invert a move table: for each target, the squares that reach it"""
+    reverse = [[] for _ in range(90)]
+    for sq in range(90):
+        for entry in table[sq]:
+            if blocked:
+                to_sq, block = entry
+                reverse[to_sq].append((sq, block))
+            else:
+                reverse[entry].append((sq, None))
+    return reverse
+
+
+# Squares from which a piece of the given type (and colour) attacks a square
+HORSE_ATTACKS = _reverse_table(HORSE_MOVES, blocked=True)
+ELEPHANT_ATTACKS = {side: _reverse_table(ELEPHANT_MOVES[side], blocked=True)
+                    for side in (RED, BLACK)}
+ADVISOR_ATTACKS = {side: _reverse_table(ADVISOR_MOVES[side]) for side in (RED, BLACK)}
+KING_ATTACKS = {side: _reverse_table(KING_MOVES[side]) for side in (RED, BLACK)}
+PAWN_ATTACKS = {side: _reverse_table(PAWN_MOVES[side]) for side in (RED, BLACK)}
+
+
+def _build_zobrist_keys():
+    """Random 64-bit keys for every (piece, square) and for black to move.
+
+    The generator is seeded so keys are identical from run to run.
+    """
+    rng = random.Random(0x5EED)
+    keys = [None] * 24
+    for piece in (RED | KING, RED | ADVISOR, RED | ELEPHANT, RED | HORSE,
+                  RED | CHARIOT, RED | CANNON, RED | PAWN,
+                  BLACK | KING, BLACK | ADVISOR, BLACK | ELEPHANT, BLACK | HORSE,
+                  BLACK | CHARIOT, BLACK | CANNON, BLACK | PAWN):
+        keys[piece] = [rng.getrandbits(64) for _ in range(90)]
+    return keys, rng.getrandbits(64)
+
+
+ZOBRIST_KEYS, ZOBRIST_BLACK_TO_MOVE = _build_zobrist_keys()
+
+
+def _build_piece_square_tables():
+    """Material plus positional score of each piece on each square.
+
+    These are the material and position terms of evaluate_position_simple
+    written out per square: center-file and river-crossing bonuses for
+    chariot, horse and cannon, and the advancement bonus for pawns.
+    Values are from black's point of view, so red entries are negative.
+    """
+    tables = [None] * 24
+    for side in (RED, BLACK):
+        for piece_type in range(KING, PAWN + 1):
+            table = []
+            for sq in range(90):
+                row, col = POS_OF[sq]
+                score = PIECE_VALUES[piece_type]
+
+                if piece_type in (CHARIOT, HORSE, CANNON):
+                    # Bonus for controlling center files
+                    if 2 <= col <= 6:
+                        score += 20
+                    # Bonus for penetration
+                    if side == BLACK and row > 4:
+                        score += 50
+                    elif side == RED and row < 5:
+                        score += 50
+
+                if piece_type == PAWN:
+                    if side == BLACK:
+                        if row > 4:  # Crossed river
+                            score += 50 + (row - 4) * 20
+                        else:
+                            score += row * 10
+                    else:
+                        if row < 5:
+                            score += 50 + (4 - row) * 20
+                        else:
+                            score += (9 - row) * 10
+
+                table.append(score if side == BLACK else -score)
+            tables[side | piece_type] = table
+    return tables
+
+
+PIECE_SQUARE_VALUES = _build_piece_square_tables()
+
+# Transposition table bound types
+TT_EXACT = 0
+TT_LOWER = 1   # score is a lower bound (search failed high)
+TT_UPPER = 2   # score is an upper bound (search failed low)
+
+
+class TranspositionTable:
+    """Fixed-size table of searched positions, indexed by Zobrist key.
+
+    Each slot holds (key, depth, flag, score, best_move).  A slot is
+    overwritten by a different position, or by a search of the same
+    position that is at least as deep.
+    """
+
+    def __init__(self, size=1 << 18):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self.entries = [None] * self.size
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def probe(self, key):
+        """Return the entry stored for key, or None"""
+        entry = self.entries[key % self.size]
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def store(self, key, depth, flag, score, best_move):
+        index = key % self.size
+        entry = self.entries[index]
+        if entry is None or entry[0] != key or depth >= entry[1]:
+            self.entries[index] = (key, depth, flag, score, best_move)
+            self.stores += 1
+
+
+# Lowest-attacker value for a square nobody attacks
+NO_ATTACKER = 10000
+
+# Move ordering bands: hash move, then captures that don't lose material
+# (most valuable victim, least valuable attacker), then killer moves, then
+# captures that lose material by SEE, then the history score
+HASH_MOVE_SCORE = 1 << 30
+CAPTURE_SCORE = 1 << 26
+KILLER_SCORES = (1 << 25, (1 << 25) - 1)
+LOSING_CAPTURE_SCORE = (1 << 25) - 2
+HISTORY_LIMIT = 1 << 24
+
+# Deepest ply the killer table has room for
+MAX_PLY = 64
+
+# Quiescence search skips a capture that can't lift the score to alpha
+# even if the victim comes off for free and the position gains this much
+DELTA_MARGIN = 200
+
+# Half-width of the window searched around the previous iteration's score
+ASPIRATION_WINDOW = 50
+
+# The search looks at the clock once every this many nodes (a power of two)
+NODE_CHECK_INTERVAL = 256
+
+
+class AttackMap:
+    """Which squares each side attacks in one position.
+
+    counts[side][sq] is the number of the side's pieces that could
+    capture a piece standing on sq, and lowest[side][sq] is the value
+    of the cheapest of them (NO_ATTACKER if there are none).  For the
+    side that owns the piece on sq these are its defenders.
+    cannon_counts[side][sq] is the part of counts made up of cannons.
+    """
+
+    def __init__(self):
+        self.counts = {RED: [0] * 90, BLACK: [0] * 90}
+        self.lowest = {RED: [NO_ATTACKER] * 90, BLACK: [NO_ATTACKER] * 90}
+        self.cannon_counts = {RED: [0] * 90, BLACK: [0] * 90}
+
+
+class SearchTimeout(Exception):
+    """Raised inside the search tree when the deadline has passed"""
+
+
+class SearchStats:
+    """Counters and results of one find_best_move call.
+
+    nodes counts all searched positions, qnodes the quiescence ones
+    among them.  beta_cutoffs counts interior nodes that failed high,
+    first_move_cutoffs those where the first move tried did it.
+    iterations holds (depth, score, (from_sq, to_sq), nodes, seconds
+    since the start) for every completed iteration, and pv the
+    principal variation of the last one, black's move first.
+    """
+
+    def __init__(self):
+        self.nodes = 0
+        self.qnodes = 0
+        self.beta_cutoffs = 0
+        self.first_move_cutoffs = 0
+        self.tt_probes = 0
+        self.tt_hits = 0
+        self.iterations = []
+        self.pv = []
+        self.seconds = 0.0
+
+    @property
+    def depth(self):
+        """Depth of the last completed iteration, 0 if none completed"""
+        return self.iterations[-1][0] if self.iterations else 0
+
+    @property
+    def first_move_cutoff_ratio(self):
+        return self.first_move_cutoffs / self.beta_cutoffs if self.beta_cutoffs else 0.0
+
+    def add_counters(self, counters):
+        """Add a tuple from ChessEngine.search_counters() to the counts"""
+        nodes, qnodes, beta_cutoffs, first_move_cutoffs, tt_probes, tt_hits = counters
+        self.nodes += nodes
+        self.qnodes += qnodes
+        self.beta_cutoffs += beta_cutoffs
+        self.first_move_cutoffs += first_move_cutoffs
+        self.tt_probes += tt_probes
+        self.tt_hits += tt_hits
+
+    def as_dict(self):
+        """The stats as plain types, for json; moves are [from_sq, to_sq]"""
+        return {
+            'depth': self.depth,
+            'seconds': round(self.seconds, 4),
+            'nodes': self.nodes,
+            'qnodes': self.qnodes,
+            'nodes_per_second': round(self.nodes / self.seconds) if self.seconds else 0,
+            'beta_cutoffs': self.beta_cutoffs,
+            'first_move_cutoff_ratio': round(self.first_move_cutoff_ratio, 4),
+            'tt_probes': self.tt_probes,
+            'tt_hits': self.tt_hits,
+            'iterations': [
+                {'depth': depth, 'score': score, 'move': list(move),
+                 'nodes': nodes, 'seconds': round(seconds, 4)}
+                for depth, score, move, nodes, seconds in self.iterations
+            ],
+            'pv': [list(move) for move in self.pv],
+        }
+
+
+class ChessEngine:
+
+    def __init__(self, tt_size=1 << 18, tt=None):
+        # Black is the AI side, red is the human side.  tt replaces the
+        # private transposition table, e.g. with one shared by processes
+        self.tt = tt if tt is not None else TranspositionTable(tt_size)
+        # Search counters, see reset_counters; stats describes the last
+        # find_best_move call
+        self.reset_counters()
+        self.stats = SearchStats()
+        self.deadline = None
+        self.stop_event = None
+        # Optional tablebase.Tablebases, probed at every search node
+        self.tablebases = None
+        self.clear_move_ordering()
+        self.initialize_board()
+
+    def reset_counters(self):
+        """Zero the node, cutoff and transposition table counters"""
+        self.nodes = 0
+        self.qnodes = 0
+        self.beta_cutoffs = 0
+        self.first_move_cutoffs = 0
+        self.tt.reset_stats()
+
+    def search_counters(self):
+        """The counters as (nodes, qnodes, beta_cutoffs, first_move_cutoffs,
+        tt_probes, tt_hits)"""
+        return (self.nodes, self.qnodes, self.beta_cutoffs, self.first_move_cutoffs,
+                self.tt.hits + self.tt.misses, self.tt.hits)
+
+    def clear_move_ordering(self):
+        """Forget killer moves and history scores from earlier searches"""
+        self.killers = [[None, None] for _ in range(MAX_PLY)]
+        self.history = [0] * (90 * 90)
+
+    def initialize_board(self):
+        # Initialize empty board
+        self.squares = [EMPTY] * 90
+
+        # Set up initial piece positions
+        self.setup_pieces()
+        self._rebuild_piece_lists()
+        self.zobrist_key = self.compute_zobrist_key()
+        self.material_score = self.compute_material_score()
+        self.undo_stack = []
+
+    def _rebuild_piece_lists(self):
+        """Collect the occupied squares of each side and both general squares.
+
+        piece_sets[side] and king_squares[side] are then kept up to date
+        by make_move/unmake_move, so nothing needs to scan the board.
+        """
+        self.piece_sets = {RED: set(), BLACK: set()}
+        self.king_squares = {RED: None, BLACK: None}
+        for sq, piece in enumerate(self.squares):
+            if piece:
+                self.piece_sets[piece & COLOR_MASK].add(sq)
+                if piece & TYPE_MASK == KING:
+                    self.king_squares[piece & COLOR_MASK] = sq
+
+    def get_board(self):
+        """Return the board as 10 rows of piece strings (None if empty)"""
+        names = PIECE_STRINGS
+        squares = self.squares
+        return [[names[squares[row * 9 + col]] for col in range(9)] for row in range(10)]
+
+    def set_board(self, board):
+        """Load a board given as 10 rows of piece strings (None if empty)"""
+        self.squares = [PIECE_CODES[piece] if piece else EMPTY
+                        for row in board for piece in row]
+        self._rebuild_piece_lists()
+        self.zobrist_key = self.compute_zobrist_key()
+        self.material_score = self.compute_material_score()
+        self.undo_stack = []
+
+    def piece_at(self, row, col):
+        """Return the piece string on a square, or None"""
+        return PIECE_STRINGS[self.squares[row * 9 + col]]
+
+    def compute_material_score(self):
+        """Sum the piece-square values from scratch (black minus red)"""
+        score = 0
+        for sq, piece in enumerate(self.squares):
+            if piece:
+                score += PIECE_SQUARE_VALUES[piece][sq]
+        return score
+
+    def compute_zobrist_key(self):
+        """Hash the pieces on the board from scratch (side to move excluded)"""
+        key = 0
+        for sq, piece in enumerate(self.squares):
+            if piece:
+                key ^= ZOBRIST_KEYS[piece][sq]
+        return key
+
+    def make_move(self, move):
+        """Play a (from_sq, to_sq) move and push it on the undo stack.
+
+        The board, piece lists, general squares, Zobrist key and material
+        score are all updated here in O(1); unmake_move reverses the last
+        call.
+        Returns the captured piece code (EMPTY if none).
+        """
+        from_sq, to_sq = move
+        squares = self.squares
+        piece = squares[from_sq]
+        captured = squares[to_sq]
+        self.undo_stack.append((from_sq, to_sq, captured))
+        side = piece & COLOR_MASK
+        keys = ZOBRIST_KEYS[piece]
+        self.zobrist_key ^= keys[from_sq] ^ keys[to_sq]
+        values = PIECE_SQUARE_VALUES[piece]
+        self.material_score += values[to_sq] - values[from_sq]
+        own = self.piece_sets[side]
+        own.remove(from_sq)
+        own.add(to_sq)
+        if piece & TYPE_MASK == KING:
+            self.king_squares[side] = to_sq
+        if captured:
+            self.zobrist_key ^= ZOBRIST_KEYS[captured][to_sq]
+            self.material_score -= PIECE_SQUARE_VALUES[captured][to_sq]
+            self.piece_sets[captured & COLOR_MASK].remove(to_sq)
+            if captured & TYPE_MASK == KING:
+                self.king_squares[captured & COLOR_MASK] = None
+        squares[to_sq] = piece
+        squares[from_sq] = EMPTY
+        return captured
+
+    def unmake_move(self):
+        """Take back the last move made with make_move"""
+        from_sq, to_sq, captured = self.undo_stack.pop()
+        squares = self.squares
+        piece = squares[to_sq]
+        side = piece & COLOR_MASK
+        keys = ZOBRIST_KEYS[piece]
+        self.zobrist_key ^= keys[from_sq] ^ keys[to_sq]
+        values = PIECE_SQUARE_VALUES[piece]
+        self.material_score -= values[to_sq] - values[from_sq]
+        own = self.piece_sets[side]
+        own.remove(to_sq)
+        own.add(from_sq)
+        if piece & TYPE_MASK == KING:
+            self.king_squares[side] = from_sq
+        if captured:
+            self.zobrist_key ^= ZOBRIST_KEYS[captured][to_sq]
+            self.material_score += PIECE_SQUARE_VALUES[captured][to_sq]
+            self.piece_sets[captured & COLOR_MASK].add(to_sq)
+            if captured & TYPE_MASK == KING:
+                self.king_squares[captured & COLOR_MASK] = to_sq
+        squares[from_sq] = piece
+        squares[to_sq] = captured
+
+    def move_piece(self, from_pos, to_pos):
+        """make_move for (row, col) positions; returns the captured piece string"""
+        captured = self.make_move((from_pos[0] * 9 + from_pos[1], to_pos[0] * 9 + to_pos[1]))
+        return PIECE_STRINGS[captured]
+
+    def setup_pieces(self):
+        # Red pieces (bottom)
+        red_pieces = {
+            (9, 0): 'R車', (9, 1): 'R馬', (9, 2): 'R相',
+            (9, 3): 'R仕', (9, 4): 'R帥', (9, 5): 'R仕',
+            (9, 6): 'R相', (9, 7): 'R馬', (9, 8): 'R車',
+            (7, 1): 'R炮', (7, 7): 'R炮',
+            (6, 0): 'R兵', (6, 2): 'R兵', (6, 4): 'R兵',
+            (6, 6): 'R兵', (6, 8): 'R兵'
+        }
+
+        # Black pieces (top)
+        black_pieces = {
+            (0, 0): 'B車', (0, 1): 'B馬', (0, 2): 'B象',
+            (0, 3): 'B士', (0, 4): 'B將', (0, 5): 'B士',
+            (0, 6): 'B象', (0, 7): 'B馬', (0, 8): 'B車',
+            (2, 1): 'B炮', (2, 7): 'B炮',
+            (3, 0): 'B卒', (3, 2): 'B卒', (3, 4): 'B卒',
+            (3, 6): 'B卒', (3, 8): 'B卒'
+        }
+
+        # Place pieces on board
+        for pos, piece in red_pieces.items():
+            row, col = pos
+            self.squares[row * 9 + col] = PIECE_CODES[piece]
+
+        for pos, piece in black_pieces.items():
+            row, col = pos
+            self.squares[row * 9 + col] = PIECE_CODES[piece]
+
+    # Add piece movement validation(8 functions)
+
+    def is_valid_move(self, from_pos, to_pos):
+        """Check a move given as (row, col) positions"""
+        to_row, to_col = to_pos
+
+        # Basic validation
+        if not (0 <= to_row < 10 and 0 <= to_col < 9):
+            return False
+
+        return self._is_valid_move(from_pos[0] * 9 + from_pos[1], to_row * 9 + to_col)
+
+    def _is_valid_move(self, from_sq, to_sq):
+        """Check a move between two square indices"""
+        squares = self.squares
+        piece = squares[from_sq]
+        if not piece:
+            return False
+
+        # Can't capture own pieces
+        target = squares[to_sq]
+        if target and (target & COLOR_MASK) == (piece & COLOR_MASK):
+            return False
+
+        piece_type = piece & TYPE_MASK
+
+        # Check specific piece movement rules
+        if piece_type == KING:  # General/King
+            return self.is_valid_general_move(from_sq, to_sq)
+        elif piece_type == ADVISOR:  # Advisor
+            return self.is_valid_advisor_move(from_sq, to_sq)
+        elif piece_type == ELEPHANT:  # Elephant
+            return self.is_valid_elephant_move(from_sq, to_sq)
+        elif piece_type == HORSE:  # Horse
+            return self.is_valid_horse_move(from_sq, to_sq)
+        elif piece_type == CHARIOT:  # Chariot
+            return self.is_valid_chariot_move(from_sq, to_sq)
+        elif piece_type == CANNON:  # Cannon
+            return self.is_valid_cannon_move(from_sq, to_sq)
+        elif piece_type == PAWN:  # Pawn
+            return self.is_valid_pawn_move(from_sq, to_sq)
+
+        return False
+
+    def is_valid_general_move(self, from_sq, to_sq):
+        from_row, from_col = POS_OF[from_sq]
+        to_row, to_col = POS_OF[to_sq]
+
+        # Check if move is within palace (3x3 grid)
+        if not _in_palace(to_row, to_col, self.squares[from_sq] & COLOR_MASK):
+            return False
+
+        # Can only move one step horizontally or vertically
+        if abs(to_row - from_row) + abs(to_col - from_col) != 1:
+            return False
+
+        return True
+
+    def is_valid_advisor_move(self, from_sq, to_sq):
+        from_row, from_col = POS_OF[from_sq]
+        to_row, to_col = POS_OF[to_sq]
+
+        # Check if move is within palace
+        if not _in_palace(to_row, to_col, self.squares[from_sq] & COLOR_MASK):
+            return False
+
+        # Must move exactly one step diagonally
+        if abs(to_row - from_row) != 1 or abs(to_col - from_col) != 1:
+            return False
+
+        return True
+
+    def is_valid_elephant_move(self, from_sq, to_sq):
+        from_row, from_col = POS_OF[from_sq]
+        to_row, to_col = POS_OF[to_sq]
+
+        # Cannot cross river
+        if self.squares[from_sq] & RED:  # Red elephant
+            if to_row < 5:  # Cannot cross river
+                return False
+        else:  # Black elephant
+            if to_row > 4:  # Cannot cross river
+                return False
+
+        # Must move exactly two steps diagonally
+        if abs(to_row - from_row) != 2 or abs(to_col - from_col) != 2:
+            return False
+
+        # Check if there's a piece blocking the elephant's path
+        if self.squares[(from_sq + to_sq) // 2]:
+            return False
+
+        return True
+
+    def is_valid_horse_move(self, from_sq, to_sq):
+        from_row, from_col = POS_OF[from_sq]
+        to_row, to_col = POS_OF[to_sq]
+
+        # Must move in an L-shape (2 steps in one direction, 1 step in perpendicular direction)
+        row_diff = abs(to_row - from_row)
+        col_diff = abs(to_col - from_col)
+        if not ((row_diff == 2 and col_diff == 1) or (row_diff == 1 and col_diff == 2)):
+            return False
+
+        # Check for blocking piece
+        if row_diff == 2:
+            if self.squares[from_sq + (9 if to_row > from_row else -9)]:
+                return False
+        else:
+            if self.squares[from_sq + (1 if to_col > from_col else -1)]:
+                return False
+
+        return True
+
+    def _pieces_between(self, from_sq, to_sq):
+        """Count pieces strictly between two squares on a rank or file"""
+        if ROW_OF[from_sq] == ROW_OF[to_sq]:
+            step = 1
+        else:
+            step = 9
+        start, end = min(from_sq, to_sq), max(from_sq, to_sq)
+        squares = self.squares
+        count = 0
+        for sq in range(start + step, end, step):
+            if squares[sq]:
+                count += 1
+        return count
+
+    def is_valid_chariot_move(self, from_sq, to_sq):
+        # Must move horizontally or vertically
+        if ROW_OF[from_sq] != ROW_OF[to_sq] and COL_OF[from_sq] != COL_OF[to_sq]:
+            return False
+
+        # Check if path is clear
+        return self._pieces_between(from_sq, to_sq) == 0
+
+    def is_valid_cannon_move(self, from_sq, to_sq):
+        # Must move horizontally or vertically
+        if ROW_OF[from_sq] != ROW_OF[to_sq] and COL_OF[from_sq] != COL_OF[to_sq]:
+            return False
+
+        # Count pieces between from and to positions
+        pieces_between = self._pieces_between(from_sq, to_sq)
+
+        # If capturing, need exactly one piece between
+        if self.squares[to_sq]:
+            return pieces_between == 1
+        # If not capturing, path must be clear
+        return pieces_between == 0
+
+    def is_valid_pawn_move(self, from_sq, to_sq):
+        # Forward only before the river, forward or sideways after it
+        return to_sq in PAWN_MOVES[self.squares[from_sq] & COLOR_MASK][from_sq]
+
+    # the following 3 functions (conbined with on_click function) is to add the CHECK feature
+    def _king_square(self, side):
+        """Square of the given side's general, or None"""
+        return self.king_squares[side]
+
+    def find_kings(self):
+        """Find (row, col) positions of both kings/generals"""
+        red_king_sq = self._king_square(RED)
+        black_king_sq = self._king_square(BLACK)
+        return (POS_OF[red_king_sq] if red_king_sq is not None else None,
+                POS_OF[black_king_sq] if black_king_sq is not None else None)
+
+    def is_position_under_attack(self, pos, attacking_color):
+        """Check if a position is under attack by pieces of the given color"""
+        target_sq = pos[0] * 9 + pos[1]
+        side = SIDES[attacking_color]
+
+        # Check from every piece of the attacking side
+        for sq in self.piece_sets[side]:
+            # Check if this piece can move to the target position
+            if self._is_valid_move(sq, target_sq):
+                return True
+        return False
+
+    def is_generals_facing(self):
+        """Check if the two generals are facing each other directly"""
+        red_king_sq = self._king_square(RED)
+        black_king_sq = self._king_square(BLACK)
+
+        # If either king is missing, return False
+        if red_king_sq is None or black_king_sq is None:
+            return False
+
+        # Check if generals are in the same column
+        if COL_OF[red_king_sq] != COL_OF[black_king_sq]:
+            return False
+
+        # Check if there are any pieces between the generals
+        return self._pieces_between(black_king_sq, red_king_sq) == 0
+
+    def is_in_check(self, color):
+        """Check if the king of the given color is in check"""
+        return self._in_check(SIDES[color])
+
+    def _in_check(self, side):
+        """Check if the general of the given side is in check.
+
+        Instead of asking every enemy piece whether it can reach the
+        king, probe outward from the king square: the open file to the
+        other general, chariot and cannon rays, and the squares a horse,
+        pawn, advisor, elephant or general would have to stand on.
+        """
+        red_king_sq = self.king_squares[RED]
+        black_king_sq = self.king_squares[BLACK]
+
+        if red_king_sq is None or black_king_sq is None:
+            return False
+
+        squares = self.squares
+
+        # First check the special case of facing generals
+        if COL_OF[red_king_sq] == COL_OF[black_king_sq]:
+            for sq in range(black_king_sq + 9, red_king_sq, 9):
+                if squares[sq]:
+                    break
+            else:
+                return True  # Both kings are in check in this case
+
+        if side == RED:
+            king_sq, enemy = red_king_sq, BLACK
+        else:
+            king_sq, enemy = black_king_sq, RED
+
+        # Chariot: first piece on a ray; cannon: second piece on a ray
+        enemy_chariot = enemy | CHARIOT
+        enemy_cannon = enemy | CANNON
+        for ray in RAYS[king_sq]:
+            screen = False
+            for sq in ray:
+                piece = squares[sq]
+                if not piece:
+                    continue
+                if not screen:
+                    if piece == enemy_chariot:
+                        return True
+                    screen = True
+                else:
+                    if piece == enemy_cannon:
+                        return True
+                    break
+
+        # Horse: the leg is the square next to the horse, not the king
+        enemy_horse = enemy | HORSE
+        for sq, leg in HORSE_ATTACKS[king_sq]:
+            if squares[sq] == enemy_horse and not squares[leg]:
+                return True
+
+        enemy_pawn = enemy | PAWN
+        for sq, _ in PAWN_ATTACKS[enemy][king_sq]:
+            if squares[sq] == enemy_pawn:
+                return True
+
+        # Advisors, elephants and the general only matter if the king
+        # has somehow left its own half; these tables are empty otherwise
+        for sq, _ in ADVISOR_ATTACKS[enemy][king_sq]:
+            if squares[sq] == enemy | ADVISOR:
+                return True
+        for sq, eye in ELEPHANT_ATTACKS[enemy][king_sq]:
+            if squares[sq] == enemy | ELEPHANT and not squares[eye]:
+                return True
+        for sq, _ in KING_ATTACKS[enemy][king_sq]:
+            if squares[sq] == enemy | KING:
+                return True
+
+        return False
+
+    def _all_pieces(self):
+        """Occupied squares of both sides"""
+        return self.piece_sets[RED] | self.piece_sets[BLACK]
+
+    def get_all_valid_moves(self, color):
+        """Get all valid moves for a given color as (row, col) pairs"""
+        return [(POS_OF[from_sq], POS_OF[to_sq])
+                for from_sq, to_sq in self.generate_moves(SIDES[color])]
+
+    def generate_moves(self, side):
+        """Generate pseudo-legal moves for a side as (from_sq, to_sq) pairs.
+
+        Walks the side's piece list and uses the precomputed move tables
+        instead of trying every destination with is_valid_move; moves
+        come out in ascending (from_sq, to_sq) order.
+        """
+        squares = self.squares
+        moves = []
+        for from_sq in sorted(self.piece_sets[side]):
+            piece = squares[from_sq]
+            piece_type = piece & TYPE_MASK
+            targets = []
+
+            if piece_type == CHARIOT or piece_type == CANNON:
+                is_cannon = piece_type == CANNON
+                for ray in RAYS[from_sq]:
+                    screen = False
+                    for to_sq in ray:
+                        target = squares[to_sq]
+                        if not screen:
+                            if not target:
+                                targets.append(to_sq)
+                                continue
+                            if not is_cannon:
+                                if not target & side:
+                                    targets.append(to_sq)
+                                break
+                            screen = True
+                        elif target:
+                            if not target & side:
+                                targets.append(to_sq)
+                            break
+                targets.sort()
+            elif piece_type == HORSE:
+                for to_sq, leg in HORSE_MOVES[from_sq]:
+                    if not squares[leg]:
+                        targets.append(to_sq)
+            elif piece_type == ELEPHANT:
+                for to_sq, eye in ELEPHANT_MOVES[side][from_sq]:
+                    if not squares[eye]:
+                        targets.append(to_sq)
+            elif piece_type == PAWN:
+                targets = PAWN_MOVES[side][from_sq]
+            elif piece_type == ADVISOR:
+                targets = ADVISOR_MOVES[side][from_sq]
+            else:
+                targets = KING_MOVES[side][from_sq]
+
+            for to_sq in targets:
+                if not squares[to_sq] & side:
+                    moves.append((from_sq, to_sq))
+        return moves
+
+    def generate_captures(self, side):
+        """Pseudo-legal captures for a side, in generate_moves order"""
+        squares = self.squares
+        return [move for move in self.generate_moves(side) if squares[move[1]]]
+
+    def generate_legal_moves(self, side):
+        """Moves for a side that don't leave its own king in check"""
+        moves = []
+        for move in self.generate_moves(side):
+            self.make_move(move)
+            if not self._in_check(side):
+                moves.append(move)
+            self.unmake_move()
+        return moves
+
+    def is_checkmate(self, color):
+        """
+        Check if the given color is in checkmate.
+        Returns True if the player has no legal moves to escape check.
+        """
+        side = SIDES[color]
+        # If not in check, can't be checkmate
+        if not self._in_check(side):
+            return False
+
+        # Try every possible move for every piece of the current player
+        for move in self.generate_moves(side):
+            # Try the move
+            self.make_move(move)
+
+            # Check if still in check
+            still_in_check = self._in_check(side)
+
+            # Undo the move
+            self.unmake_move()
+
+            # If any move gets out of check, not checkmate
+            if not still_in_check:
+                return False
+
+        # If no legal moves found, it's checkmate
+        return True
+
+    def compute_attack_map(self):
+        """Build the AttackMap for the current position in one pass.
+
+        Chariots and cannons attack along their rays up to and including
+        the first piece they could capture; every other piece attacks the
+        squares in its move table that are not blocked.
+        """
+        squares = self.squares
+        attack_map = AttackMap()
+        for side in (RED, BLACK):
+            counts = attack_map.counts[side]
+            lowest = attack_map.lowest[side]
+            for from_sq in self.piece_sets[side]:
+                piece_type = squares[from_sq] & TYPE_MASK
+                value = PIECE_VALUES[piece_type]
+                targets = []
+
+                if piece_type == CHARIOT:
+                    for ray in RAYS[from_sq]:
+                        for to_sq in ray:
+                            targets.append(to_sq)
+                            if squares[to_sq]:
+                                break
+                elif piece_type == CANNON:
+                    cannon_counts = attack_map.cannon_counts[side]
+                    for ray in RAYS[from_sq]:
+                        screen = False
+                        for to_sq in ray:
+                            if not screen:
+                                if squares[to_sq]:
+                                    screen = True
+                                continue
+                            targets.append(to_sq)
+                            cannon_counts[to_sq] += 1
+                            if squares[to_sq]:
+                                break
+                elif piece_type == HORSE:
+                    for to_sq, leg in HORSE_MOVES[from_sq]:
+                        if not squares[leg]:
+                            targets.append(to_sq)
+                elif piece_type == ELEPHANT:
+                    for to_sq, eye in ELEPHANT_MOVES[side][from_sq]:
+                        if not squares[eye]:
+                            targets.append(to_sq)
+                elif piece_type == PAWN:
+                    targets = PAWN_MOVES[side][from_sq]
+                elif piece_type == ADVISOR:
+                    targets = ADVISOR_MOVES[side][from_sq]
+                else:
+                    targets = KING_MOVES[side][from_sq]
+
+                for to_sq in targets:
+                    counts[to_sq] += 1
+                    if value < lowest[to_sq]:
+                        lowest[to_sq] = value
+        return attack_map
+
+    def _in_check_from_map(self, side, attack_map):
+        """Same answer as _in_check, read from a precomputed AttackMap"""
+        king_sq = self.king_squares[side]
+        if king_sq is None or self.king_squares[RED if side == BLACK else BLACK] is None:
+            return False
+        if self.is_generals_facing():
+            return True
+        return attack_map.counts[RED if side == BLACK else BLACK][king_sq] > 0
+
+    def _least_valuable_attacker(self, to_sq, side):
+        """Square of the side's cheapest piece that can capture on to_sq, or None.
+
+        Looks outward from to_sq with the pieces currently on the board,
+        so it sees cannon screens appear and disappear during an exchange.
+        """
+        squares = self.squares
+        pawn = side | PAWN
+        for sq, _ in PAWN_ATTACKS[side][to_sq]:
+            if squares[sq] == pawn:
+                return sq
+        advisor = side | ADVISOR
+        for sq, _ in ADVISOR_ATTACKS[side][to_sq]:
+            if squares[sq] == advisor:
+                return sq
+        elephant = side | ELEPHANT
+        for sq, eye in ELEPHANT_ATTACKS[side][to_sq]:
+            if squares[sq] == elephant and not squares[eye]:
+                return sq
+        horse = side | HORSE
+        for sq, leg in HORSE_ATTACKS[to_sq]:
+            if squares[sq] == horse and not squares[leg]:
+                return sq
+
+        # Chariot: first piece on a ray; cannon: second piece on a ray
+        chariot_sq = None
+        cannon = side | CANNON
+        chariot = side | CHARIOT
+        for ray in RAYS[to_sq]:
+            screen = False
+            for sq in ray:
+                piece = squares[sq]
+                if not piece:
+                    continue
+                if not screen:
+                    if piece == chariot and chariot_sq is None:
+                        chariot_sq = sq
+                    screen = True
+                else:
+                    if piece == cannon:
+                        return sq
+                    break
+        if chariot_sq is not None:
+            return chariot_sq
+
+        king = side | KING
+        for sq, _ in KING_ATTACKS[side][to_sq]:
+            if squares[sq] == king:
+                return sq
+        return None
+
+    def _exchange_sequence(self, from_sq, to_sq):
+        """Material won by capturing on to_sq from from_sq, then recapturing.
+
+        Both sides keep recapturing with their least valuable attacker and
+        either may stop when continuing would lose material.  Pieces are
+        lifted off the board as they are used and put back afterwards.
+        """
+        squares = self.squares
+        saved = [(to_sq, squares[to_sq])]
+        gains = [EXCHANGE_VALUES[squares[to_sq] & TYPE_MASK]]
+        piece = squares[from_sq]
+        side = RED if piece & BLACK else BLACK
+
+        while True:
+            # Play the capture
+            saved.append((from_sq, piece))
+            squares[from_sq] = EMPTY
+            squares[to_sq] = piece
+            on_square = EXCHANGE_VALUES[piece & TYPE_MASK]
+
+            from_sq = self._least_valuable_attacker(to_sq, side)
+            if from_sq is None:
+                break
+            gains.append(on_square - gains[-1])
+            piece = squares[from_sq]
+            side = RED if side == BLACK else BLACK
+
+        for sq, original in reversed(saved):
+            squares[sq] = original
+
+        # Each side stops the sequence when recapturing doesn't pay
+        while len(gains) > 1:
+            last = gains.pop()
+            gains[-1] = -max(-gains[-1], last)
+        return gains[0]
+
+    def static_exchange(self, move):
+        """Static exchange evaluation of a capture given as (from_sq, to_sq).
+
+        Returns the material the moving side wins (negative if it loses)
+        after the best sequence of recaptures on the target square.
+        """
+        if not self.squares[move[1]]:
+            return 0
+        return self._exchange_sequence(move[0], move[1])
+
+    def exchange_loss(self, sq):
+        """Material the owner of the piece on sq stands to lose there.
+
+        The opponent starts the exchange with its least valuable attacker
+        and only does so if it wins material; 0 means the piece is safe.
+        """
+        piece = self.squares[sq]
+        enemy = RED if piece & BLACK else BLACK
+        from_sq = self._least_valuable_attacker(sq, enemy)
+        if from_sq is None:
+            return 0
+        return max(0, self._exchange_sequence(from_sq, sq))
+
+    def evaluate_board(self):
+        score = 0
+        squares = self.squares
+        for sq in self._all_pieces():
+            piece = squares[sq]
+            piece_type = piece & TYPE_MASK
+            value = PIECE_VALUES[piece_type]
+            row = ROW_OF[sq]
+            if piece & BLACK:  # Black pieces (AI)
+                score += value
+                # Bonus for advanced positions
+                if piece_type == PAWN or piece_type == CANNON:
+                    score += (row * 10)  # Encourage forward movement
+            else:  # Red pieces (Human)
+                score -= value
+                if piece_type == PAWN or piece_type == CANNON:
+                    score -= ((9 - row) * 10)
+
+        return score
+
+    def evaluate_piece_safety(self, sq, piece, attack_map=None):
+        """Evaluate how safe a piece is in its current position"""
+        if attack_map is None:
+            attack_map = self.compute_attack_map()
+        safety_score = 0
+        side = piece & COLOR_MASK
+        enemy = RED if side == BLACK else BLACK
+
+        # Penalty for material the opponent can win on this square; the
+        # general is left to the king safety and checkmate terms.  The
+        # exchange isn't played out when every attacker is worth more
+        # than the piece and there are as many defenders as attackers.
+        attackers = attack_map.counts[enemy][sq]
+        if attackers and piece & TYPE_MASK != KING:
+            if (attack_map.lowest[enemy][sq] <= PIECE_VALUES[piece & TYPE_MASK]
+                    or attack_map.counts[side][sq] < attackers):
+                # Halved because the side to move may still save the piece
+                safety_score -= self.exchange_loss(sq) // 2
+
+        return safety_score
+
+    def evaluate_king_safety(self, color, attack_map=None):
+        """Evaluate king safety and surrounding protection"""
+        if attack_map is None:
+            attack_map = self.compute_attack_map()
+        side = SIDES[color]
+        king_sq = self._king_square(side)
+        if king_sq is None:
+            return -9999
+
+        king_row, king_col = POS_OF[king_sq]
+        safety = 0
+
+        # Check protecting pieces
+        for dr in [-1, 0, 1]:
+            for dc in [-1, 0, 1]:
+                r, c = king_row + dr, king_col + dc
+                if 0 <= r < 10 and 0 <= c < 9:
+                    if self.squares[r * 9 + c] & side:
+                        safety += 30
+
+        # Penalty for exposed king
+        if self._in_check_from_map(side, attack_map):
+            safety -= 200
+
+        return safety
+
+    def evaluate_checkmate_potential(self, color, attack_map=None):
+        """Evaluate how close we are to achieving checkmate"""
+        if attack_map is None:
+            attack_map = self.compute_attack_map()
+        side = SIDES[color]
+        opposing_side = RED if side == BLACK else BLACK
+        king_sq = self._king_square(opposing_side)
+        score = 0
+
+        if king_sq is None:
+            return 0
+
+        king_row, king_col = POS_OF[king_sq]
+        squares = self.squares
+
+        # Count attacking pieces near opponent's king
+        attackers = 0
+        attack_value = 0
+        for dr in range(-2, 3):
+            for dc in range(-2, 3):
+                r, c = king_row + dr, king_col + dc
+                if 0 <= r < 10 and 0 <= c < 9:
+                    piece = squares[r * 9 + c]
+                    if piece & side:
+                        attackers += 1
+                        # Higher value for powerful pieces near the king
+                        if piece & TYPE_MASK in (CHARIOT, HORSE, CANNON):
+                            attack_value += 50
+                        else:
+                            attack_value += 20
+
+        score += attackers * 30 + attack_value
+
+        # Bonus if opponent's king has limited mobility
+        escape_moves = 0
+        threats = attack_map.counts[side]
+        cannon_threats = attack_map.cannon_counts[side]
+        for to_sq in KING_MOVES[opposing_side][king_sq]:
+            if squares[to_sq] & opposing_side:
+                continue
+            # Only a cannon can lose its attack when the king steps in
+            # (the king may have been its screen), so anything else
+            # attacking the square rules it out without trying the move
+            if threats[to_sq] > cannon_threats[to_sq]:
+                continue
+
+            # Try the move
+            self.make_move((king_sq, to_sq))
+
+            if not self._in_check(opposing_side):
+                escape_moves += 1
+
+            # Restore the position
+            self.unmake_move()
+
+        # Higher score when opponent has fewer escape moves
+        score += (9 - escape_moves) * 50
+
+        # Extra bonus if opponent is in check
+        if self._in_check_from_map(opposing_side, attack_map):
+            score += 200
+
+        return score
+
+    def evaluate_position_simple(self):
+        # Material and position terms are kept up to date by make_move
+        score = self.material_score
+
+        # One attack map is shared by all the terms below
+        attack_map = self.compute_attack_map()
+
+        # Calculate piece safety
+        squares = self.squares
+        for sq in self.piece_sets[BLACK]:
+            score += self.evaluate_piece_safety(sq, squares[sq], attack_map)
+        for sq in self.piece_sets[RED]:
+            score -= self.evaluate_piece_safety(sq, squares[sq], attack_map)
+
+        # Add checkmate potential evaluation
+        checkmate_score = (self.evaluate_checkmate_potential('black', attack_map)
+                           - self.evaluate_checkmate_potential('red', attack_map))
+        score += checkmate_score * 2  # Give high weight to checkmate potential
+
+        # King safety evaluation
+        king_safety = (self.evaluate_king_safety('black', attack_map)
+                       - self.evaluate_king_safety('red', attack_map))
+        score += king_safety
+
+        return score
+
+    def _move_sorting_score(self, move, hash_move=None, killers=(None, None)):
+        """Cheap ordering score for a move; nothing is played on the board"""
+        if move == hash_move:
+            return HASH_MOVE_SCORE
+        from_sq, to_sq = move
+        victim = self.squares[to_sq]
+        if victim:
+            # Only a capture by a more valuable piece can lose material
+            attacker = self.squares[from_sq]
+            if EXCHANGE_VALUES[attacker & TYPE_MASK] > EXCHANGE_VALUES[victim & TYPE_MASK]:
+                exchange = self.static_exchange(move)
+                if exchange < 0:
+                    return LOSING_CAPTURE_SCORE + exchange
+            # MVV-LVA: most valuable victim first, cheapest attacker breaks ties
+            return (CAPTURE_SCORE + PIECE_VALUES[victim & TYPE_MASK] * 10
+                    - EXCHANGE_VALUES[attacker & TYPE_MASK] // 100)
+        if move == killers[0]:
+            return KILLER_SCORES[0]
+        if move == killers[1]:
+            return KILLER_SCORES[1]
+        return self.history[from_sq * 90 + to_sq]
+
+    def order_moves(self, moves, hash_move=None, ply=0):
+        """Sort moves in place, best candidates first"""
+        killers = self.killers[ply] if ply < MAX_PLY else (None, None)
+        moves.sort(key=lambda move: self._move_sorting_score(move, hash_move, killers),
+                   reverse=True)
+
+    def _record_cutoff(self, move, depth, ply):
+        """Remember a quiet move that caused a beta cutoff"""
+        if self.squares[move[1]]:
+            return  # Captures are already ordered by MVV-LVA and SEE
+        if ply < MAX_PLY:
+            killers = self.killers[ply]
+            if killers[0] != move:
+                killers[1] = killers[0]
+                killers[0] = move
+        index = move[0] * 90 + move[1]
+        self.history[index] += depth * depth
+        if self.history[index] > HISTORY_LIMIT:
+            self.history = [value // 2 for value in self.history]
+
+    def minimax(self, depth, alpha, beta, maximizing_player, ply=0):
+        """Minimax algorithm with alpha-beta pruning and simplified evaluation.
+
+        Interior nodes are looked up in and saved to the transposition
+        table.  Moves are tried hash move first, then captures by
+        MVV-LVA, then killer moves, then by history score.  ply is the
+        distance from the root, used to index the killer table.  At
+        depth 0 the quiescence search takes over.  Positions covered by
+        an endgame tablebase get its exact score instead.
+        """
+        tablebases = self.tablebases
+        if tablebases is not None and (len(self.piece_sets[RED]) + len(self.piece_sets[BLACK])
+                                       <= tablebases.max_pieces):
+            score = tablebases.score(self, BLACK if maximizing_player else RED)
+            if score is not None:
+                return score
+
+        if depth == 0:
+            return self.quiescence(alpha, beta, maximizing_player, ply)
+
+        self.nodes += 1
+        if not self.nodes % NODE_CHECK_INTERVAL:
+            self._check_deadline()
+
+        key = self.zobrist_key ^ ZOBRIST_BLACK_TO_MOVE if maximizing_player else self.zobrist_key
+        alpha_orig, beta_orig = alpha, beta
+        hash_move = None
+        entry = self.tt.probe(key)
+        if entry is not None:
+            _, entry_depth, flag, entry_score, hash_move = entry
+            if entry_depth >= depth:
+                # A bound only decides the node if it falls outside the
+                # window; narrowing the window with it would let the
+                # bound be stored back as an exact score
+                if flag == TT_EXACT:
+                    return entry_score
+                if flag == TT_LOWER and entry_score >= beta:
+                    return entry_score
+                if flag == TT_UPPER and entry_score <= alpha:
+                    return entry_score
+
+        moves = self.generate_moves(BLACK if maximizing_player else RED)
+        self.order_moves(moves, hash_move, ply)
+        best_move = None
+
+        if maximizing_player:
+            max_eval = float('-inf')
+
+            for move in moves:
+                # Store and make move
+                self.make_move(move)
+
+                if not self._in_check(BLACK):
+                    eval = self.minimax(depth - 1, alpha, beta, False, ply + 1)
+                    if eval > max_eval:
+                        max_eval = eval
+                        best_move = move
+                    alpha = max(alpha, eval)
+
+                # Restore position
+                self.unmake_move()
+
+                if beta <= alpha:
+                    self.beta_cutoffs += 1
+                    if move is moves[0]:
+                        self.first_move_cutoffs += 1
+                    self._record_cutoff(move, depth, ply)
+                    break
+            best_eval = max_eval if max_eval != float('-inf') else self.evaluate_position_simple()
+        else:
+            min_eval = float('inf')
+
+            for move in moves:
+                self.make_move(move)
+
+                if not self._in_check(RED):
+                    eval = self.minimax(depth - 1, alpha, beta, True, ply + 1)
+                    if eval < min_eval:
+                        min_eval = eval
+                        best_move = move
+                    beta = min(beta, eval)
+
+                # Restore position
+                self.unmake_move()
+
+                if beta <= alpha:
+                    self.beta_cutoffs += 1
+                    if move is moves[0]:
+                        self.first_move_cutoffs += 1
+                    self._record_cutoff(move, depth, ply)
+                    break
+            best_eval = min_eval if min_eval != float('inf') else self.evaluate_position_simple()
+
+        if best_eval <= alpha_orig:
+            flag = TT_UPPER
+        elif best_eval >= beta_orig:
+            flag = TT_LOWER
+        else:
+            flag = TT_EXACT
+        self.tt.store(key, depth, flag, best_eval, best_move)
+        return best_eval
+
+    def quiescence(self, alpha, beta, maximizing_player, ply=0):
+        """Search captures only until the position is quiet.
+
+        The side to move may stand pat on the static evaluation instead
+        of capturing.  Captures that lose material by static exchange or
+        that can't reach alpha even with DELTA_MARGIN to spare are
+        skipped.  A side in check can't stand pat and searches all its
+        evasions instead.
+        """
+        self.nodes += 1
+        self.qnodes += 1
+        if not self.nodes % NODE_CHECK_INTERVAL:
+            self._check_deadline()
+
+        side = BLACK if maximizing_player else RED
+        in_check = self._in_check(side)
+        if ply >= MAX_PLY:
+            return self.evaluate_position_simple()
+
+        if in_check:
+            stand_pat = None
+            moves = self.generate_moves(side)
+        else:
+            stand_pat = self.evaluate_position_simple()
+            if maximizing_player:
+                if stand_pat >= beta:
+                    return stand_pat
+                alpha = max(alpha, stand_pat)
+            else:
+                if stand_pat <= alpha:
+                    return stand_pat
+                beta = min(beta, stand_pat)
+            moves = self.generate_captures(side)
+        self.order_moves(moves, None, ply)
+
+        squares = self.squares
+        best_eval = stand_pat
+        for move in moves:
+            if stand_pat is not None:
+                # A pruned capture still counts as its optimistic score
+                # so the result stays a valid bound for the parent
+                gain = PIECE_VALUES[squares[move[1]] & TYPE_MASK] + DELTA_MARGIN
+                if maximizing_player and stand_pat + gain <= alpha:
+                    best_eval = max(best_eval, stand_pat + gain)
+                    continue
+                if not maximizing_player and stand_pat - gain >= beta:
+                    best_eval = min(best_eval, stand_pat - gain)
+                    continue
+                if self.static_exchange(move) < 0:
+                    continue
+
+            self.make_move(move)
+            if not self._in_check(side):
+                eval = self.quiescence(alpha, beta, not maximizing_player, ply + 1)
+                if best_eval is None:
+                    best_eval = eval
+                elif maximizing_player:
+                    best_eval = max(best_eval, eval)
+                else:
+                    best_eval = min(best_eval, eval)
+                if maximizing_player:
+                    alpha = max(alpha, eval)
+                else:
+                    beta = min(beta, eval)
+            self.unmake_move()
+
+            if beta <= alpha:
+                break
+
+        if best_eval is None:
+            # No way out of check
+            return self.evaluate_position_simple()
+        return best_eval
+
+    def _check_deadline(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            raise SearchTimeout
+        if self.stop_event is not None and self.stop_event.is_set():
+            raise SearchTimeout
+
+    def _search_root(self, moves, depth, alpha, beta):
+        """Search the legal root moves for black inside (alpha, beta).
+
+        Returns (score, move) for the best move.  If every move fails
+        low the score is an upper bound, and if one fails high the
+        search stops there and the score is a lower bound.
+        """
+        best_score = float('-inf')
+        best_move = None
+        for move in moves:
+            self.make_move(move)
+            score = self.minimax(depth - 1, alpha, beta, False, 1)
+            self.unmake_move()
+
+            if score > best_score:
+                best_score = score
+                best_move = move
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                break
+        return best_score, best_move
+
+    def expected_reply(self):
+        """Red's best move here according to the last search, or None.
+
+        The move comes from the transposition table, so it is only known
+        for positions inside the last search tree, such as the one after
+        black's chosen move.  It is returned as a pair of (row, col)
+        positions.
+        """
+        entry = self.tt.probe(self.zobrist_key)
+        if entry is None or entry[4] not in self.generate_legal_moves(RED):
+            return None
+        move = entry[4]
+        return POS_OF[move[0]], POS_OF[move[1]]
+
+    def score_move(self, move, depth, alpha=float('-inf'), beta=float('inf'),
+                   deadline=None, stop_event=None):
+        """Search one of black's moves depth plies deep and return its score.
+
+        This is one root move of find_best_move on its own, for callers
+        that split the root moves among several searchers.  deadline is
+        an absolute time.time() value; when it passes or stop_event is
+        set, SearchTimeout is raised with the board restored.
+        """
+        self.deadline = deadline
+        self.stop_event = stop_event
+        undo_depth = len(self.undo_stack)
+        self.make_move(move)
+        try:
+            return self.minimax(depth - 1, alpha, beta, False, 1)
+        finally:
+            while len(self.undo_stack) > undo_depth:
+                self.unmake_move()
+            self.deadline = None
+            self.stop_event = None
+
+    def find_best_move(self, max_time=5.0, max_depth=3, stop_event=None):
+        """Search the current position and return the best move for black.
+
+        Iterative deepening from depth 1 to max_depth.  Each iteration
+        tries the previous best move first (the transposition table
+        supplies the rest of the principal variation as hash moves) and
+        searches a narrow aspiration window around the previous score,
+        widening to a full window if the result falls outside it.  The
+        search aborts once max_time seconds have passed and the move of
+        the last completed iteration is played.  Setting stop_event (a
+        threading.Event) from another thread aborts the search the same
+        way.
+
+        The move is returned as a pair of (row, col) positions, or None.
+        Afterwards self.stats holds the SearchStats of the search.
+        """
+        start_time = time.time()
+        self.stats = stats = SearchStats()
+
+        moves = self.generate_legal_moves(BLACK)
+        if not moves:
+            return None
+
+        # Killers and history from a previous move describe another position
+        self.clear_move_ordering()
+        self.order_moves(moves)
+        best_move = moves[0]
+        best_score = None
+
+        self.reset_counters()
+        self.deadline = start_time + max_time
+        self.stop_event = stop_event
+        undo_depth = len(self.undo_stack)
+        try:
+            for search_depth in range(1, max_depth + 1):
+                if best_score is None:
+                    alpha, beta = float('-inf'), float('inf')
+                else:
+                    alpha = best_score - ASPIRATION_WINDOW
+                    beta = best_score + ASPIRATION_WINDOW
+
+                score, move = self._search_root(moves, search_depth, alpha, beta)
+                if score <= alpha or score >= beta:
+                    score, move = self._search_root(moves, search_depth,
+                                                    float('-inf'), float('inf'))
+
+                best_score, best_move = score, move
+                stats.iterations.append((search_depth, score, move, self.nodes,
+                                         time.time() - start_time))
+                # Principal variation first in the next iteration
+                moves.remove(move)
+                moves.insert(0, move)
+        except SearchTimeout:
+            # Take back the moves of the unfinished iteration
+            while len(self.undo_stack) > undo_depth:
+                self.unmake_move()
+        finally:
+            self.deadline = None
+            self.stop_event = None
+
+        stats.add_counters(self.search_counters())
+        stats.seconds = time.time() - start_time
+        stats.pv = self.principal_variation(best_move, max(stats.depth, 1))
+        return POS_OF[best_move[0]], POS_OF[best_move[1]]
+
+    def principal_variation(self, move, length):
+        """Black's move followed by the replies stored in the transposition
+        table, at most length moves in all, as a list of (from_sq, to_sq)"""
+        pv = [move]
+        self.make_move(move)
+        side = RED
+        seen = set()
+        while len(pv) < length:
+            key = self.zobrist_key ^ ZOBRIST_BLACK_TO_MOVE if side == BLACK else self.zobrist_key
+            entry = self.tt.probe(key)
+            if key in seen or entry is None or entry[4] not in self.generate_legal_moves(side):
+                break
+            seen.add(key)
+            pv.append(entry[4])
+            self.make_move(entry[4])
+            side = BLACK if side == RED else RED
+        for _ in pv:
+            self.unmake_move()
+        return pv
@@ -0,0 +1,69 @@
+"""Rolling record of how long the AI takes to reply.
+
+LatencyHistogram keeps the last few hundred reply times and reports
+their percentiles, plus a text histogram with doubling buckets:
+
+    latencies = LatencyHistogram()
+    latencies.record(0.84)
+    print(latencies.format())
+"""
+
+import bisect
+from collections import deque
+
+# Upper bucket edges in seconds; the last bucket takes everything slower
+BUCKET_EDGES = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+
+class LatencyHistogram:
+    """The last window reply times, in seconds"""
+
+    def __init__(self, window=500):
+        self.samples = deque(maxlen=window)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, percent):
+        """Nearest-rank percentile of the window, or None if it is empty"""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        rank = max(1, -(-len(ordered) * percent // 100))
+        return ordered[int(rank) - 1]
+
+    def summary(self):
+        """{'count', 'p50', 'p90', 'p99', 'max'} over the window"""
+        return {
+            'count': len(self.samples),
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': max(self.samples) if self.samples else None,
+        }
+
+    def buckets(self):
+        """Sample counts per bucket, one more than there are BUCKET_EDGES"""
+        counts = [0] * (len(BUCKET_EDGES) + 1)
+        for seconds in self.samples:
+            counts[bisect.bisect_left(BUCKET_EDGES, seconds)] += 1
+        return counts
+
+    def format(self, width=40):
+        """The percentiles and a bar per bucket as printable text"""
+        if not self.samples:
+            return "no replies recorded"
+        summary = self.summary()
+        lines = [f"{summary['count']} replies  p50 {summary['p50']:.3f}s  "
+                 f"p90 {summary['p90']:.3f}s  p99 {summary['p99']:.3f}s  "
+                 f"max {summary['max']:.3f}s"]
+        counts = self.buckets()
+        largest = max(counts)
+        labels = [f"<= {edge:g}s" for edge in BUCKET_EDGES] + [f"> {BUCKET_EDGES[-1]:g}s"]
+        for label, count in zip(labels, counts):
+            if count:
+                lines.append(f"{label:>9} {count:6d} {'#' * max(1, count * width // largest)}")
+        return '\n'.join(lines)
@@ -0,0 +1,300 @@
+"""Root-split parallel search over a pool of worker processes.
+
+Threads don't help a pure Python search because of the GIL, so
+ParallelSearch hands black's root moves to worker processes, each with
+its own ChessEngine.  At every depth the first (principal variation)
+move is searched alone to get a bound, then the remaining moves are
+searched in parallel (young brothers wait).  The best score found so
+far is kept in shared memory and every root move is searched with it
+as alpha.  Workers look at it again whenever they check the clock, and
+a search that sees it rise starts over inside the narrower window; the
+subtrees it already finished are in the transposition table.  All
+workers read and write one SharedTranspositionTable.
+
+Run as a script to compare it with the single-process search:
+
+    python parallel.py --depth 3 --processes 4
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+
+from engine import BLACK, POS_OF, ChessEngine, SearchStats, SearchTimeout
+from tablebase import Tablebases
+
+# Packed transposition table entry: two 64-bit words per slot, the
+# data word and the key xor'ed with it.  Data bits from low to high:
+# from square (7), to square (7), flag (2), depth (8), unused (8),
+# score + SCORE_OFFSET (32).  A from square of NO_MOVE means no move.
+NO_MOVE = 127
+SCORE_OFFSET = 1 << 31
+
+# How often the parent checks the deadline and stop event while waiting
+POLL_INTERVAL = 0.02
+
+
+class SharedTranspositionTable:
+    """Transposition table in shared memory, usable from many processes.
+
+    Same interface as engine.TranspositionTable.  Each slot is stored as
+    the data word and key ^ data, and writes take no lock: a slot torn
+    by two processes writing at once no longer xors back to its key, so
+    probe treats it as a miss.  The process that creates the table
+    (name=None) owns it and must unlink() it; workers attach by name.
+    """
+
+    def __init__(self, size=1 << 18, name=None):
+        self.size = size
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size * 16)
+        self.name = self.shm.name
+        self.words = self.shm.buf.cast('Q')
+        self.reset_stats()
+
+    def close(self):
+        self.words.release()
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+    def clear(self):
+        self.shm.buf[:self.size * 16] = bytes(self.size * 16)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def probe(self, key):
+        """Return the entry stored for key as a tuple, or None"""
+        index = (key % self.size) * 2
+        data = self.words[index + 1]
+        if self.words[index] ^ data != key:
+            self.misses += 1
+            return None
+        self.hits += 1
+        from_sq = data & 127
+        best_move = None if from_sq == NO_MOVE else (from_sq, (data >> 7) & 127)
+        return (key, (data >> 16) & 255, (data >> 14) & 3,
+                (data >> 32) - SCORE_OFFSET, best_move)
+
+    def store(self, key, depth, flag, score, best_move):
+        index = (key % self.size) * 2
+        old = self.words[index + 1]
+        if self.words[index] ^ old == key and depth < (old >> 16) & 255:
+            return
+        from_sq, to_sq = best_move if best_move is not None else (NO_MOVE, 0)
+        data = (from_sq | to_sq << 7 | flag << 14 | min(depth, 255) << 16
+                | (int(score) + SCORE_OFFSET) << 32)
+        self.words[index + 1] = data
+        self.words[index] = key ^ data
+        self.stores += 1
+
+
+# Worker process state, set up by _init_worker
+_engine = None
+_alpha = None
+_stop = None
+
+
+def _init_worker(tt_size, tt_name, alpha, stop, tablebase_dir):
+    global _engine, _alpha, _stop
+    _engine = ChessEngine(tt=SharedTranspositionTable(tt_size, tt_name))
+    if tablebase_dir is not None:
+        _engine.tablebases = Tablebases(tablebase_dir)
+    _alpha = alpha
+    _stop = stop
+
+
+class _RootMoveStop:
+    """stop_event for a root move searched with the given alpha.
+
+    Set when the pool is stopped or when another worker has raised the
+    shared alpha above it, so the engine notices both at its regular
+    deadline checks.
+    """
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+
+    def is_set(self):
+        return _stop.is_set() or _alpha.value > self.alpha
+
+
+def _search_root_move(board, move, depth, deadline):
+    """Score one root move in a worker process.
+
+    Returns (move, score, alpha, counters) where alpha is the bound the
+    move was searched with: a score at or below it is only an upper
+    bound.  The score is None if the search was stopped.  counters are
+    the worker's ChessEngine.search_counters() for this move, restarts
+    included.
+    """
+    if _stop.is_set():
+        return move, None, None, None
+    _engine.set_board(board)
+    _engine.reset_counters()
+    alpha = _alpha.value
+    while True:
+        try:
+            score = _engine.score_move(move, depth, alpha, float('inf'), deadline,
+                                       _RootMoveStop(alpha))
+            break
+        except SearchTimeout:
+            if _stop.is_set() or time.time() > deadline:
+                return move, None, None, _engine.search_counters()
+            # Another move raised the bound: search again inside it
+            alpha = _alpha.value
+    with _alpha.get_lock():
+        if score > _alpha.value:
+            _alpha.value = score
+    return move, score, alpha, _engine.search_counters()
+
+
+class ParallelSearch:
+    """Searches black's root moves in a pool of worker processes.
+
+    The pool and its shared transposition table are created once and
+    reused for every move; call close() (or use the object as a context
+    manager) to shut them down.  Workers load the endgame tables in
+    tablebase_dir, if given.
+    """
+
+    def __init__(self, processes=None, tt_size=1 << 18, tablebase_dir=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.tt = SharedTranspositionTable(tt_size)
+        self.alpha = multiprocessing.Value('d', float('-inf'))
+        self.stop = multiprocessing.Event()
+        self.pool = multiprocessing.Pool(
+            self.processes,
+            initializer=_init_worker,
+            initargs=(tt_size, self.tt.name, self.alpha, self.stop, tablebase_dir)
+        )
+
+    def close(self):
+        self.stop.set()
+        self.pool.terminate()
+        self.pool.join()
+        self.tt.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def find_best_move(self, engine, max_time=5.0, max_depth=3, stop_event=None):
+        """Search engine's position and return the best move for black.
+
+        Same contract as ChessEngine.find_best_move: iterative deepening
+        up to max_depth, and the move of the last completed iteration is
+        returned when max_time runs out or stop_event is set.  The
+        workers' counters are summed into engine.stats.
+        """
+        start_time = time.time()
+        deadline = start_time + max_time
+        engine.stats = stats = SearchStats()
+        moves = engine.generate_legal_moves(BLACK)
+        if not moves:
+            return None
+        engine.clear_move_ordering()
+        engine.order_moves(moves)
+        board = engine.get_board()
+        best_move = moves[0]
+
+        self.stop.clear()
+        for depth in range(1, max_depth + 1):
+            results = self._search_depth(board, moves, depth, deadline, stop_event, stats)
+            if results is None:
+                break
+
+            # Only scores above the bound they were searched with are exact
+            best_move, best_score = max(
+                (result for result in results if result[1] > result[2]),
+                key=lambda result: result[1])[:2]
+            scores = {move: score for move, score, _, _ in results}
+            moves.sort(key=lambda move: (move == best_move, scores[move]), reverse=True)
+            stats.iterations.append((depth, best_score, best_move, stats.nodes,
+                                     time.time() - start_time))
+
+        stats.seconds = time.time() - start_time
+        stats.pv = engine.principal_variation(best_move, max(stats.depth, 1))
+        return POS_OF[best_move[0]], POS_OF[best_move[1]]
+
+    def _search_depth(self, board, moves, depth, deadline, stop_event, stats):
+        """Score every root move at one depth, or return None if stopped.
+
+        The counters of every finished worker task are added to stats.
+        """
+        self.alpha.value = float('-inf')
+        first = self.pool.apply_async(_search_root_move, (board, moves[0], depth, deadline))
+        pending = [first]
+        if self._wait(pending, deadline, stop_event):
+            pending += [
+                self.pool.apply_async(_search_root_move, (board, move, depth, deadline))
+                for move in moves[1:]
+            ]
+            self._wait(pending, deadline, stop_event)
+        results = [result.get() for result in pending]
+        for _, _, _, counters in results:
+            if counters is not None:
+                stats.add_counters(counters)
+        if len(results) < len(moves) or any(score is None for _, score, _, _ in results):
+            return None
+        return results
+
+    def _wait(self, pending, deadline, stop_event):
+        """Wait for the pending results; on timeout stop the workers"""
+        for result in pending:
+            while not result.ready():
+                if time.time() > deadline or (stop_event is not None and stop_event.is_set()):
+                    self.stop.set()
+                    for other in pending:
+                        other.wait()
+                    return False
+                result.wait(POLL_INTERVAL)
+        return True
+
+
+def measure_speedup(board=None, depth=3, processes=None):
+    """Time a fixed-depth search in one process and in the pool.
+
+    Returns (serial_seconds, parallel_seconds, processes).  The pool is
+    started before the clock starts.
+    """
+    engine = ChessEngine()
+    if board is not None:
+        engine.set_board(board)
+    start = time.time()
+    engine.find_best_move(max_time=float('inf'), max_depth=depth)
+    serial = time.time() - start
+
+    with ParallelSearch(processes) as search:
+        engine = ChessEngine()
+        if board is not None:
+            engine.set_board(board)
+        start = time.time()
+        search.find_best_move(engine, max_time=float('inf'), max_depth=depth)
+        parallel = time.time() - start
+        processes = search.processes
+    return serial, parallel, processes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    serial, parallel, processes = measure_speedup(depth=args.depth, processes=args.processes)
+    print(f"depth {args.depth}: 1 process {serial:.2f}s, "
+          f"{processes} processes {parallel:.2f}s, speedup {serial / parallel:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
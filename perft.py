@@ -0,0 +1,172 @@
+"""Perft: count the legal move paths from a position to a fixed depth.
+
+Perft exercises exactly the move generator (generate_moves plus the
+in-check filter), so it both times the generator and checks it: the
+counts below are reference values, and any change to move generation
+must reproduce them.  Positions are given in xiangqi FEN, black's back
+rank first, with 'w' or 'r' for red to move and 'b' for black.
+
+    python perft.py                      # run the suite
+    python perft.py --depth 4            # only up to depth 4
+    python perft.py --fen FEN --depth 3 --divide
+"""
+
+import argparse
+import sys
+import time
+
+from book import format_move
+from engine import BLACK, PIECE_CODES, RED, ChessEngine
+
+FEN_PIECES = {
+    'k': '將', 'a': '士', 'b': '象', 'n': '馬', 'r': '車', 'c': '炮', 'p': '卒',
+    'K': '帥', 'A': '仕', 'B': '相', 'N': '馬', 'R': '車', 'C': '炮', 'P': '兵',
+}
+
+START_FEN = 'rnbakabnr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RNBAKABNR w'
+
+# (name, FEN, node counts for depth 1, 2, ...).  The start position
+# counts are the published ones; the others were cross-checked against
+# the original is_valid_move/is_in_check rules.
+PERFT_SUITE = [
+    ('start', START_FEN,
+     [44, 1920, 79666, 3290240]),
+    # Only a horse stands between the generals, so it can't leave the file
+    ('flying general', '4k4/9/9/9/4n4/9/9/7C1/9/R3K4 b',
+     [3, 94, 730, 22725]),
+    # Cannons with one, two and no screens on their rays; red is in check
+    ('cannon screens', '2bak4/9/4c4/9/2p1P1c2/9/4C4/2n6/4A4/3K5 w',
+     [2, 56, 978, 28782]),
+    # Horses with blocked and open legs around both generals
+    ('horse legs', '3k5/4a4/3n1n3/3RP4/9/4N4/3p5/9/4A4/5K3 b',
+     [14, 293, 3903, 88448]),
+    ('middlegame', 'r1bakab1r/9/1cn3nc1/p1p1p1p1p/9/2P6/P3P1P1P/1CN1C1N2/9/R1BAKAB1R b',
+     [39, 1321, 52520, 1832312]),
+]
+
+
+def parse_fen(fen):
+    """Return (board rows of piece strings, side to move) for a FEN"""
+    fields = fen.split()
+    rows = fields[0].split('/')
+    if len(rows) != 10:
+        raise ValueError(f"FEN needs 10 ranks: {fen!r}")
+    board = []
+    for rank in rows:
+        row = []
+        for char in rank:
+            if char.isdigit():
+                row.extend([None] * int(char))
+            elif char in FEN_PIECES:
+                row.append(('R' if char.isupper() else 'B') + FEN_PIECES[char])
+            else:
+                raise ValueError(f"bad FEN piece {char!r}")
+        if len(row) != 9:
+            raise ValueError(f"FEN rank needs 9 files: {rank!r}")
+        board.append(row)
+    side = BLACK if len(fields) > 1 and fields[1] == 'b' else RED
+    for row in board:
+        for piece in row:
+            if piece and piece not in PIECE_CODES:
+                raise ValueError(f"unknown piece {piece!r}")
+    return board, side
+
+
+def format_fen(board, side):
+    """Inverse of parse_fen: the FEN for board rows and side to move"""
+    letters = {('R' if char.isupper() else 'B') + piece: char
+               for char, piece in FEN_PIECES.items()}
+    ranks = []
+    for row in board:
+        rank = ''
+        empty = 0
+        for piece in row:
+            if piece is None:
+                empty += 1
+                continue
+            if empty:
+                rank += str(empty)
+                empty = 0
+            rank += letters[piece]
+        ranks.append(rank + (str(empty) if empty else ''))
+    return '/'.join(ranks) + (' b' if side == BLACK else ' w')
+
+
+def perft(engine, depth, side):
+    """Number of legal move sequences of length depth for side to move"""
+    if depth == 0:
+        return 1
+    other = BLACK if side == RED else RED
+    nodes = 0
+    for move in engine.generate_moves(side):
+        engine.make_move(move)
+        if not engine._in_check(side):
+            nodes += 1 if depth == 1 else perft(engine, depth - 1, other)
+        engine.unmake_move()
+    return nodes
+
+
+def divide(engine, depth, side):
+    """Perft split by root move: [(move, nodes)]"""
+    other = BLACK if side == RED else RED
+    counts = []
+    for move in engine.generate_legal_moves(side):
+        engine.make_move(move)
+        counts.append((move, perft(engine, depth - 1, other)))
+        engine.unmake_move()
+    return counts
+
+
+def run_suite(max_depth, out=sys.stdout):
+    """Check every suite position up to max_depth; returns True if all match"""
+    engine = ChessEngine(tt_size=1)
+    all_ok = True
+    total_nodes = 0
+    total_time = 0.0
+    for name, fen, expected in PERFT_SUITE:
+        board, side = parse_fen(fen)
+        engine.set_board(board)
+        for depth, reference in enumerate(expected[:max_depth], 1):
+            start = time.perf_counter()
+            nodes = perft(engine, depth, side)
+            elapsed = time.perf_counter() - start
+            total_nodes += nodes
+            total_time += elapsed
+            ok = nodes == reference
+            all_ok = all_ok and ok
+            print(f"{name:16} depth {depth}  {nodes:10d} nodes  {elapsed:7.2f}s  "
+                  f"{nodes / max(elapsed, 1e-9):9.0f} nodes/s  "
+                  f"{'ok' if ok else f'FAIL, expected {reference}'}", file=out)
+    print(f"total {total_nodes} nodes in {total_time:.2f}s, "
+          f"{total_nodes / max(total_time, 1e-9):.0f} nodes/s", file=out)
+    return all_ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move generator perft.')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fen', help='count this position instead of the suite')
+    parser.add_argument('--divide', action='store_true', help='print counts per root move')
+    args = parser.parse_args()
+
+    if args.fen is None:
+        sys.exit(0 if run_suite(args.depth) else 1)
+
+    board, side = parse_fen(args.fen)
+    engine = ChessEngine(tt_size=1)
+    engine.set_board(board)
+    start = time.perf_counter()
+    if args.divide:
+        counts = divide(engine, args.depth, side)
+        for move, nodes in counts:
+            print(f"{format_move(move)}: {nodes}")
+        nodes = sum(nodes for _, nodes in counts)
+        print(f"{len(counts)} moves")
+    else:
+        nodes = perft(engine, args.depth, side)
+    elapsed = time.perf_counter() - start
+    print(f"{nodes} nodes in {elapsed:.2f}s, {nodes / max(elapsed, 1e-9):.0f} nodes/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Per-move profiles of the AI search, for finding slow positions.
+
+MoveProfiler runs one search at a time under a profiler and writes the
+result to its directory, named by move number and the searched
+position's FEN, and adds a line to index.txt with the time taken:
+
+    cprofile   NNN_<fen>.pstats, for pstats, snakeviz or gprof2dot
+    sample     NNN_<fen>.collapsed, stacks sampled every few
+               milliseconds in the collapsed format read by
+               flamegraph.pl and speedscope
+
+cProfile times every call and slows the search down noticeably; the
+sampler only looks at the stack now and then, so it barely does.  The
+game turns it on with CHESS_PROFILE=cprofile or CHESS_PROFILE=sample
+(files go to CHESS_PROFILE_DIR, default ./profiles).  A single
+position can be profiled from the command line:
+
+    python profiling.py --fen FEN --mode sample --depth 4
+"""
+
+import argparse
+import cProfile
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from engine import BLACK, ChessEngine
+from perft import parse_fen
+
+PROFILE_MODES = ('cprofile', 'sample')
+
+# Seconds between stack samples
+SAMPLE_INTERVAL = 0.005
+
+
+class StackSampler:
+    """Samples one thread's stack from a helper thread.
+
+    Frames from root outwards (the caller's frames) are left out of the
+    samples.
+    """
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL, root=None):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.root = root
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and frame is not self.root:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                             f":{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def write(self, path):
+        """Write the samples as collapsed stacks, one 'a;b;c count' per line"""
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class MoveProfiler:
+    """Profiles calls one at a time and writes one file per call"""
+
+    def __init__(self, directory, mode='cprofile', interval=SAMPLE_INTERVAL):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"profile mode must be one of {', '.join(PROFILE_MODES)}, "
+                             f"not {mode!r}")
+        self.directory = directory
+        self.mode = mode
+        self.interval = interval
+        os.makedirs(directory, exist_ok=True)
+        # Number the files after those of earlier runs
+        self.count = 0
+        index_path = os.path.join(directory, 'index.txt')
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.count = sum(1 for _ in f)
+
+    def run(self, fen, func, *args, **kwargs):
+        """Call func(*args, **kwargs) under the profiler and return its result.
+
+        fen names the position being searched; the profile is written
+        even if func raises.
+        """
+        self.count += 1
+        name = f"{self.count:03d}_{fen.replace('/', '-').replace(' ', '_')}"
+        start = time.perf_counter()
+        if self.mode == 'cprofile':
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(func, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                name += '.pstats'
+                profiler.dump_stats(os.path.join(self.directory, name))
+                self._add_to_index(name, elapsed, fen)
+        else:
+            sampler = StackSampler(threading.get_ident(), self.interval, sys._getframe())
+            sampler.start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                sampler.stop()
+                name += '.collapsed'
+                sampler.write(os.path.join(self.directory, name))
+                self._add_to_index(name, elapsed, fen)
+
+    def _add_to_index(self, name, elapsed, fen):
+        with open(os.path.join(self.directory, 'index.txt'), 'a') as f:
+            f.write(f"{name}\t{elapsed:.3f}s\t{fen}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fen', required=True, help='position to search, black to move')
+    parser.add_argument('--mode', choices=PROFILE_MODES, default='cprofile')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--directory', default='profiles')
+    args = parser.parse_args()
+
+    board, side = parse_fen(args.fen)
+    if side != BLACK:
+        sys.exit("the AI plays black; give a position with black to move")
+    engine = ChessEngine()
+    engine.set_board(board)
+    profiler = MoveProfiler(args.directory, args.mode)
+    move = profiler.run(args.fen, engine.find_best_move,
+                        max_time=float('inf'), max_depth=args.depth)
+    print(f"best move {move}, {engine.stats.nodes} nodes in {engine.stats.seconds:.2f}s; "
+          f"profile written to {args.directory}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,482 @@
+"""Endgame tablebases built by retrograde analysis.
+
+A table covers one material signature, written as red's pieces then
+black's, each starting with the general: KRKA is general and chariot
+against general and advisor (letters K A B N R C P for general,
+advisor, elephant, horse, chariot, cannon, pawn).  For every placement
+of those pieces and either side to move it records whether the side
+to move wins, draws or loses, and in how many plies with best play.
+There is no stalemate in xiangqi: a side without a legal move loses.
+Repetition rules are not modelled, so a position that can't be forced
+to a result is a draw.
+
+Tables are only built with the stronger side as red; a position where
+black has that material is looked up with the board flipped top to
+bottom and the colours swapped.  A signature in which neither side has
+a horse, chariot, cannon or pawn is a draw and needs no table.
+
+Each table is a file with one byte per index: 0 for a draw (or an
+impossible placement), otherwise the number of plies to the end plus
+one.  An odd number of plies is a win for the side to move and an even
+number a loss.  Tablebases memory-maps every table in a directory.
+
+Generating a table first works out every position's moves in a process
+pool, looking up captures in the smaller tables built before it, then
+resolves the positions ply by ply from the mates backwards:
+
+    python tablebase.py --processes 4 KRKA KNPK
+"""
+
+import argparse
+import mmap
+import multiprocessing
+import os
+from array import array
+
+from engine import (ADVISOR, ADVISOR_MOVES, BLACK, CANNON, CHARIOT, COLOR_MASK,
+                    ELEPHANT, ELEPHANT_MOVES, HORSE, KING, KING_MOVES, PAWN,
+                    PAWN_MOVES, PIECE_VALUES, POS_OF, RED, TYPE_MASK, ChessEngine)
+
+PIECE_ORDER = 'KABNRCP'
+LETTER_TYPES = {'K': KING, 'A': ADVISOR, 'B': ELEPHANT, 'N': HORSE,
+                'R': CHARIOT, 'C': CANNON, 'P': PAWN}
+TYPE_LETTERS = {piece_type: letter for letter, piece_type in LETTER_TYPES.items()}
+ATTACKING_LETTERS = set('NRCP')
+
+# Probe results, for the side to move
+TB_LOSS = -1
+TB_DRAW = 0
+TB_WIN = 1
+
+# A table byte is plies + 1, so this is the longest result it can hold
+MAX_PLIES = 254
+
+# Search score of a tablebase win, less the plies it takes
+TB_WIN_SCORE = 50000
+
+TABLE_SUFFIX = '.xtb'
+
+# Table indices handed to a worker process at a time
+CHUNK_SIZE = 2048
+
+
+def flip_square(sq):
+    """Mirror a square top to bottom"""
+    row, col = POS_OF[sq]
+    return (9 - row) * 9 + col
+
+
+def _reachable_squares(piece):
+    """Every square a piece can ever stand on, in ascending order"""
+    side, piece_type = piece & COLOR_MASK, piece & TYPE_MASK
+    if piece_type in (HORSE, CHARIOT, CANNON):
+        return list(range(90))
+    steps = {
+        KING: KING_MOVES[side],
+        ADVISOR: ADVISOR_MOVES[side],
+        ELEPHANT: [[to_sq for to_sq, _ in moves] for moves in ELEPHANT_MOVES[side]],
+        PAWN: PAWN_MOVES[side],
+    }[piece_type]
+    frontier = [sq for sq, code in enumerate(ChessEngine(tt_size=1).squares) if code == piece]
+    seen = set(frontier)
+    while frontier:
+        sq = frontier.pop()
+        for to_sq in steps[sq]:
+            if to_sq not in seen:
+                seen.add(to_sq)
+                frontier.append(to_sq)
+    return sorted(seen)
+
+
+def _material(letters):
+    return sum(PIECE_VALUES[LETTER_TYPES[letter]] for letter in letters)
+
+
+def _sort_letters(letters):
+    return ''.join(sorted(letters, key=PIECE_ORDER.index))
+
+
+def split_name(name):
+    """Split a signature such as 'KRKA' into red's and black's letters"""
+    second_king = name.find('K', 1)
+    if not name.startswith('K') or second_king < 0 or any(
+            letter not in LETTER_TYPES for letter in name):
+        raise ValueError(f"not a material signature: {name!r}")
+    return name[:second_king], name[second_king:]
+
+
+def canonical_name(red, black):
+    """Table name for a material split, and whether it is colour-flipped"""
+    red, black = _sort_letters(red), _sort_letters(black)
+    if (_material(black), black) > (_material(red), red):
+        return black + red, True
+    return red + black, False
+
+
+def is_dead_draw(name):
+    """True if neither side has a piece that can give mate"""
+    return not ATTACKING_LETTERS.intersection(name)
+
+
+def sub_signatures(name):
+    """Signatures one capture away from name that need their own table"""
+    red, black = split_name(name)
+    names = set()
+    for i, letter in enumerate(red):
+        if letter != 'K':
+            names.add(canonical_name(red[:i] + red[i + 1:], black)[0])
+    for i, letter in enumerate(black):
+        if letter != 'K':
+            names.add(canonical_name(red, black[:i] + black[i + 1:])[0])
+    return {sub for sub in names if not is_dead_draw(sub)}
+
+
+class TableLayout:
+    """How the positions of one signature map to table indices.
+
+    Every piece is a digit counting through the squares it can reach;
+    the side to move is the most significant digit.  Two pieces of the
+    same kind get a digit each, so their placements appear twice.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        red, black = split_name(name)
+        self.pieces = ([RED | LETTER_TYPES[letter] for letter in red]
+                       + [BLACK | LETTER_TYPES[letter] for letter in black])
+        self.allowed = [_reachable_squares(piece) for piece in self.pieces]
+        self.digit_of = []
+        for allowed in self.allowed:
+            digits = [-1] * 90
+            for digit, sq in enumerate(allowed):
+                digits[sq] = digit
+            self.digit_of.append(digits)
+        self.weights = []
+        weight = 1
+        for allowed in reversed(self.allowed):
+            self.weights.append(weight)
+            weight *= len(allowed)
+        self.weights.reverse()
+        self.side_size = weight
+        self.size = 2 * weight
+
+    def decode(self, index):
+        """Return (side to move, square of each piece) for an index"""
+        side = BLACK if index >= self.side_size else RED
+        index %= self.side_size
+        squares = []
+        for allowed, weight in zip(self.allowed, self.weights):
+            digit, index = divmod(index, weight)
+            squares.append(allowed[digit])
+        return side, squares
+
+    def index(self, squares, side, flipped):
+        """Index of a board (list of 90 piece codes) with side to move.
+
+        Returns None if a piece stands where it could never get to in
+        a game, such as an advisor off its diagonals.
+        """
+        placed = {}
+        for sq, piece in enumerate(squares):
+            if piece:
+                if flipped:
+                    sq, piece = flip_square(sq), piece ^ COLOR_MASK
+                placed.setdefault(piece, []).append(sq)
+        if flipped:
+            side ^= COLOR_MASK
+
+        index = self.side_size if side == BLACK else 0
+        for piece, digits, weight in zip(self.pieces, self.digit_of, self.weights):
+            digit = digits[placed[piece].pop()]
+            if digit < 0:
+                return None
+            index += digit * weight
+        return index
+
+
+class Tablebases:
+    """All the tables found in a directory, memory-mapped"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.tables = {}
+        self.max_pieces = 0
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(TABLE_SUFFIX):
+                self._load(filename[:-len(TABLE_SUFFIX)])
+
+    def _load(self, name):
+        layout = TableLayout(name)
+        with open(os.path.join(self.directory, name + TABLE_SUFFIX), 'rb') as f:
+            if f.seek(0, 2) != layout.size:
+                raise ValueError(f"{name}{TABLE_SUFFIX} has the wrong size")
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.tables[name] = (layout, data)
+        self.max_pieces = max(self.max_pieces, len(layout.pieces))
+
+    def close(self):
+        for _, data in self.tables.values():
+            data.close()
+        self.tables = {}
+        self.max_pieces = 0
+
+    def probe(self, engine, side):
+        """Look up the engine's position with side to move.
+
+        Returns (result, plies) with result TB_WIN, TB_DRAW or TB_LOSS
+        for the side to move, or None if no table covers the position.
+        """
+        squares = engine.squares
+        letters = {RED: [], BLACK: []}
+        for color in (RED, BLACK):
+            for sq in engine.piece_sets[color]:
+                letters[color].append(TYPE_LETTERS[squares[sq] & TYPE_MASK])
+        name, flipped = canonical_name(''.join(letters[RED]), ''.join(letters[BLACK]))
+        if is_dead_draw(name):
+            return TB_DRAW, 0
+        table = self.tables.get(name)
+        if table is None:
+            return None
+
+        layout, data = table
+        index = layout.index(squares, side, flipped)
+        if index is None:
+            return None
+        value = data[index]
+        if not value:
+            return TB_DRAW, 0
+        plies = value - 1
+        return (TB_WIN if plies % 2 else TB_LOSS), plies
+
+    def score(self, engine, side):
+        """Search score of the position (black's point of view), or None"""
+        if len(engine.piece_sets[RED]) + len(engine.piece_sets[BLACK]) > self.max_pieces:
+            return None
+        probed = self.probe(engine, side)
+        if probed is None:
+            return None
+        result, plies = probed
+        if result == TB_DRAW:
+            return 0
+        score = (TB_WIN_SCORE - plies) * result
+        return score if side == BLACK else -score
+
+    def best_move(self, engine, side=BLACK):
+        """Fastest win, else a draw, else the slowest loss for side.
+
+        Returns a pair of (row, col) positions, or None if the position
+        or one of its successors is not covered by a table.
+        """
+        if len(engine.piece_sets[RED]) + len(engine.piece_sets[BLACK]) > self.max_pieces:
+            return None
+        if self.probe(engine, side) is None:
+            return None
+
+        opponent = RED if side == BLACK else BLACK
+        best_rank, best_move = None, None
+        for move in engine.generate_legal_moves(side):
+            engine.make_move(move)
+            probed = self.probe(engine, opponent)
+            engine.unmake_move()
+            if probed is None:
+                return None
+            result, plies = probed
+            # The opponent losing is our win: sooner is better
+            rank = (-result, -plies if result == TB_LOSS else plies)
+            if best_rank is None or rank > best_rank:
+                best_rank, best_move = rank, move
+        if best_move is None:
+            return None
+        return POS_OF[best_move[0]], POS_OF[best_move[1]]
+
+
+# Worker process state for generate_table, set up by _init_worker
+_layout = None
+_engine = None
+_tablebases = None
+
+
+def _init_worker(directory, name):
+    global _layout, _engine, _tablebases
+    _layout = TableLayout(name)
+    _engine = ChessEngine(tt_size=1)
+    _tablebases = Tablebases(directory)
+
+
+def _scan_positions(bounds):
+    """Work out the moves of the positions in range(*bounds).
+
+    For each position returns whether it is legal, the indices of the
+    positions its quiet moves lead to, and what its captures lead to
+    according to the smaller tables: the fewest plies to a win, the
+    most plies to a loss (0 for none) and whether one of them draws.
+    """
+    start, stop = bounds
+    layout, engine = _layout, _engine
+    pieces, digit_of, weights = layout.pieces, layout.digit_of, layout.weights
+
+    legal = bytearray(stop - start)
+    counts = array('H')
+    successors = array('i')
+    win_plies = array('H')
+    loss_plies = array('H')
+    draws = bytearray(stop - start)
+
+    squares = engine.squares
+    for index in range(start, stop):
+        side, piece_squares = layout.decode(index)
+        wins = losses = 0
+        count = 0
+        if len(set(piece_squares)) == len(piece_squares):
+            for sq in range(90):
+                squares[sq] = 0
+            for piece, sq in zip(pieces, piece_squares):
+                squares[sq] = piece
+            engine._rebuild_piece_lists()
+            opponent = RED if side == BLACK else BLACK
+
+            if not engine._in_check(opponent):
+                legal[index - start] = 1
+                base = index % layout.side_size + (0 if side == BLACK else layout.side_size)
+                for move in engine.generate_legal_moves(side):
+                    from_sq, to_sq = move
+                    if squares[to_sq]:
+                        engine.make_move(move)
+                        probed = _tablebases.probe(engine, opponent)
+                        engine.unmake_move()
+                        if probed is None:
+                            raise RuntimeError(f"{layout.name} needs a table that is missing")
+                        result, plies = probed
+                        if result == TB_LOSS:
+                            wins = min(wins, plies + 1) if wins else plies + 1
+                        elif result == TB_WIN:
+                            losses = max(losses, plies + 1)
+                        else:
+                            draws[index - start] = 1
+                    else:
+                        slot = piece_squares.index(from_sq)
+                        successors.append(base + (digit_of[slot][to_sq] - digit_of[slot][from_sq])
+                                          * weights[slot])
+                        count += 1
+        counts.append(count)
+        win_plies.append(wins)
+        loss_plies.append(losses)
+    return start, legal, counts, successors, win_plies, loss_plies, draws
+
+
+def generate_table(name, directory, processes=None):
+    """Build one table into directory; its sub-tables must be there"""
+    layout = TableLayout(name)
+    size = layout.size
+    legal = bytearray(size)
+    counts = array('H', bytes(2 * size))
+    win_plies = array('H', bytes(2 * size))
+    loss_plies = array('H', bytes(2 * size))
+    draws = bytearray(size)
+    chunk_successors = {}
+
+    chunks = [(start, min(start + CHUNK_SIZE, size)) for start in range(0, size, CHUNK_SIZE)]
+    with multiprocessing.Pool(processes, initializer=_init_worker,
+                              initargs=(directory, name)) as pool:
+        for start, chunk_legal, chunk_counts, successors, wins, losses, chunk_draws in (
+                pool.imap_unordered(_scan_positions, chunks)):
+            stop = start + len(chunk_legal)
+            legal[start:stop] = chunk_legal
+            counts[start:stop] = chunk_counts
+            win_plies[start:stop] = wins
+            loss_plies[start:stop] = losses
+            draws[start:stop] = chunk_draws
+            chunk_successors[start] = successors
+
+    # Flatten the successor lists, then invert them into predecessor lists
+    successors = array('i')
+    for start, _ in chunks:
+        successors.extend(chunk_successors.pop(start))
+    predecessor_counts = array('i', bytes(4 * (size + 1)))
+    for successor in successors:
+        predecessor_counts[successor + 1] += 1
+    for index in range(size):
+        predecessor_counts[index + 1] += predecessor_counts[index]
+    fill = array('i', predecessor_counts)
+    predecessors = array('i', bytes(4 * len(successors)))
+    position = 0
+    for index in range(size):
+        for successor in successors[position:position + counts[index]]:
+            predecessors[fill[successor]] = index
+            fill[successor] += 1
+        position += counts[index]
+    del successors, fill
+
+    # Resolve positions in order of plies to the end.  A position is won
+    # as soon as one move reaches a lost one, and lost once every move
+    # reaches a won one and no capture holds the draw.
+    values = bytearray(size)
+    remaining = counts
+    buckets = [[] for _ in range(MAX_PLIES + 1)]
+    for index in range(size):
+        if not legal[index]:
+            continue
+        if win_plies[index]:
+            buckets[min(win_plies[index], MAX_PLIES)].append(index)
+        elif not remaining[index] and not draws[index]:
+            buckets[loss_plies[index]].append(index)
+
+    for plies in range(MAX_PLIES):
+        for index in buckets[plies]:
+            if values[index]:
+                continue
+            values[index] = plies + 1
+            preceding = predecessors[predecessor_counts[index]:predecessor_counts[index + 1]]
+            if plies % 2:
+                for previous in preceding:
+                    if values[previous]:
+                        continue
+                    remaining[previous] -= 1
+                    if loss_plies[previous] < plies + 1:
+                        loss_plies[previous] = plies + 1
+                    if not remaining[previous] and not draws[previous] and not win_plies[previous]:
+                        buckets[min(loss_plies[previous], MAX_PLIES)].append(previous)
+            else:
+                for previous in preceding:
+                    if not values[previous]:
+                        buckets[plies + 1].append(previous)
+        buckets[plies] = None
+
+    path = os.path.join(directory, name + TABLE_SUFFIX)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(values)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def generate_tables(names, directory, processes=None, log=print):
+    """Build the tables for names, and the smaller ones they depend on"""
+    os.makedirs(directory, exist_ok=True)
+    needed = set()
+    pending = [canonical_name(*split_name(name))[0] for name in names]
+    while pending:
+        name = pending.pop()
+        if name not in needed and not is_dead_draw(name):
+            needed.add(name)
+            pending.extend(sub_signatures(name))
+
+    for name in sorted(needed, key=lambda name: (len(name), name)):
+        if os.path.exists(os.path.join(directory, name + TABLE_SUFFIX)):
+            continue
+        log(f"generating {name}")
+        generate_table(name, directory, processes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate endgame tablebases.')
+    parser.add_argument('signatures', nargs='*', default=['KRKA', 'KRKB', 'KNPK'],
+                        help='material signatures such as KRKA (default: %(default)s)')
+    parser.add_argument('--directory', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'tablebases'))
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+    generate_tables(args.signatures, args.directory, args.processes)
+
+
+if __name__ == "__main__":
+    main()